@@ -0,0 +1,94 @@
+"""
+crash_stub.py
+------------------
+A stand-in for DVRPC's crash API, for benchmarking CrashClient offline.
+
+    python -m benchmarks.crash_stub --port 8765 --delay 0.2 --fail_every 5
+
+Every GET answers with a summary shaped like the API's (crashes by year and
+mode), after delay seconds. The counts are derived from the geojson parameter,
+so the same polygon always gets the same answer. With fail_every set, every
+nth request fails with a 503, to exercise retries. Point CRASH_API_URL at
+http://localhost:<port>/summary to use it.
+
+"""
+
+import hashlib
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import click
+
+YEARS = range(2018, 2023)
+
+
+def summary(geojson: str):
+    """A crash summary by year and mode, the same for the same geojson"""
+    seed = int(hashlib.sha256(geojson.encode()).hexdigest(), 16)
+    return {
+        str(year): {
+            "mode": {
+                "Bicyclists": (seed >> (8 * i)) % 5,
+                "Pedestrians": (seed >> (8 * i + 4)) % 7,
+            }
+        }
+        for i, year in enumerate(YEARS)
+    }
+
+
+def make_server(port: int = 0, delay: float = 0.0, fail_every: int = 0):
+    """
+    Returns a stub server on localhost, not yet serving. Port 0 picks a free
+    port, see server.server_address. server.requests counts the requests served.
+    """
+    counter = itertools.count(1)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            number = next(counter)
+            server.requests = number
+            time.sleep(delay)
+            if fail_every and number % fail_every == 0:
+                self.send_error(503)
+                return
+            geojson = parse_qs(urlparse(self.path).query).get("geojson", [""])[0]
+            body = json.dumps(summary(geojson)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    server.requests = 0
+    return server
+
+
+def serve_in_background(port: int = 0, delay: float = 0.0, fail_every: int = 0):
+    """Starts a stub server on a daemon thread and returns it, stop it with shutdown()"""
+    server = make_server(port, delay, fail_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option("--port", default=8765, help="port to listen on")
+@click.option("--delay", default=0.2, help="seconds before each response")
+@click.option("--fail_every", default=0, help="answer every nth request with a 503")
+def main(port, delay, fail_every):
+    """
+    Serves a stand-in crash API on localhost
+    """
+    server = make_server(port, delay, fail_every)
+    click.echo(f"stub crash api on http://localhost:{port}/summary")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
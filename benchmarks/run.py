@@ -0,0 +1,275 @@
+"""
+run.py
+------------------
+Times StudySegment end to end and per stage against a synthetic region.
+
+    python -m benchmarks.run load --pg_config_filepath bench.cfg --grid_size 60
+    python -m benchmarks.run segments --pg_config_filepath bench.cfg --count 20
+    python -m benchmarks.run compare results/before.json results/after.json
+
+The [localhost] section of the pg config file must point at a throwaway
+database (see benchmarks/docker-compose.yml), since loading drops the lts and
+sidewalk schemas. Results are written as JSON, tagged with the current commit,
+so runs can be compared across commits.
+
+"""
+
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import click
+from lts_island_connectivity import BatchStudySegments, Instrumentation, StudySegment
+from lts_island_connectivity.crashes import CrashClient
+from lts_island_connectivity.network_islands import build_all
+from lts_island_connectivity.overlays import SUBDIVIDED_LAYERS, build_subdivided
+from lts_island_connectivity.pool import get_database
+from .crash_stub import serve_in_background
+from .synthetic import generate_region, random_segments
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(values: list):
+    values = sorted(values)
+    return {
+        "n": len(values),
+        "mean": round(statistics.mean(values), 4),
+        "median": round(statistics.median(values), 4),
+        "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 4),
+        "max": round(values[-1], 4),
+    }
+
+
+@click.group()
+def main():
+    """
+    lts island connectivity benchmarks
+    """
+    pass
+
+
+@main.command()
+@click.option("--pg_config_filepath", required=True, help="pg config of bench db")
+@click.option("--grid_size", default=60, help="nodes along each side of the grid")
+@click.option("--spacing", default=100.0, help="meters between grid nodes")
+@click.option("--organic", is_flag=True, help="jittered grid with missing links")
+def load(pg_config_filepath, grid_size, spacing, organic):
+    """
+    Generates a synthetic region and builds its islands and topology
+    """
+    db = get_database("localhost", pg_config_filepath)
+    start = time.perf_counter()
+    generate_region(db, grid_size, spacing, organic)
+    generated = time.perf_counter()
+    # the same order as `make islands`: topology, low stress networks, islands
+    build_all(db, full_refresh=True)
+    for table in SUBDIVIDED_LAYERS:
+        build_subdivided(db, table)
+    built = time.perf_counter()
+    click.echo(
+        json.dumps(
+            {
+                "generate_seconds": round(generated - start, 4),
+                "islands_and_topology_seconds": round(built - generated, 4),
+            }
+        )
+    )
+
+
+@main.command()
+@click.option("--pg_config_filepath", required=True, help="pg config of bench db")
+@click.option("--count", default=20, help="number of study segments to time")
+@click.option("--grid_size", default=60, help="grid size the region was loaded with")
+@click.option("--spacing", default=100.0, help="spacing the region was loaded with")
+@click.option("--network_type", default="lts", help="lts or sidewalk")
+@click.option("--explain", is_flag=True, help="capture query plans as well")
+@click.option("--batch", is_flag=True, help="also time BatchStudySegments")
+@click.option("--transient", is_flag=True, help="score segments in transient mode")
+@click.option("--output", help="results file, defaults to results/<commit>.json")
+def segments(
+    pg_config_filepath,
+    count,
+    grid_size,
+    spacing,
+    network_type,
+    explain,
+    batch,
+    transient,
+    output,
+):
+    """
+    Times StudySegment end to end and per stage
+    """
+    db = get_database("localhost", pg_config_filepath)
+    for table in ["blobs", "buffers", "islands", "segments", "isochrones"]:
+        db.execute(f"drop table if exists {network_type}.user_{table}")
+
+    features = random_segments(db, count, grid_size, spacing)
+    runs = []
+    for feature in features:
+        instrumentation = Instrumentation(explain=explain)
+        start = time.perf_counter()
+        segment = StudySegment(
+            network_type,
+            feature,
+            "benchmark",
+            overwrite=True,
+            pg_config_filepath=pg_config_filepath,
+            instrumentation=instrumentation,
+            transient=transient,
+        )
+        seconds = time.perf_counter() - start
+        runs.append(
+            {
+                "name": feature["properties"]["name"],
+                "seconds": round(seconds, 4),
+                "has_isochrone": segment.has_isochrone,
+                "miles": segment.miles,
+                "metrics": instrumentation.to_dict(),
+            }
+        )
+        click.echo(f"{feature['properties']['name']}: {seconds:.2f}s")
+
+    stage_seconds = {}
+    for run in runs:
+        for stage in run["metrics"]["stages"]:
+            stage_seconds.setdefault(stage["stage"], []).append(stage["seconds"])
+
+    results = {
+        "commit": _commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "params": {
+            "count": count,
+            "grid_size": grid_size,
+            "spacing": spacing,
+            "network_type": network_type,
+            "transient": transient,
+        },
+        "summary": {
+            "segment_seconds": _summary([run["seconds"] for run in runs]),
+            "stages": {k: _summary(v) for k, v in stage_seconds.items()},
+        },
+        "segments": runs,
+    }
+
+    if batch:
+        batch_features = random_segments(
+            db, count, grid_size, spacing, name_prefix="batch"
+        )
+        start = time.perf_counter()
+        BatchStudySegments(
+            network_type,
+            batch_features,
+            "benchmark",
+            overwrite=True,
+            pg_config_filepath=pg_config_filepath,
+        )
+        results["summary"]["batch_seconds"] = round(time.perf_counter() - start, 4)
+
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"{results['commit'] or 'results'}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    click.echo(json.dumps(results["summary"], indent=2, default=str))
+    click.echo(f"results written to {output}")
+
+
+@main.command()
+@click.option("--count", default=20, help="number of study area buffers")
+@click.option("--parts", default=4, help="polygons per buffer")
+@click.option("--delay", default=0.2, help="seconds the stub api takes to answer")
+@click.option(
+    "--fail_every", default=0, help="stub answers every nth request with a 503"
+)
+@click.option("--workers", default=8, help="requests CrashClient sends at once")
+def crashes(count, parts, delay, fail_every, workers):
+    """
+    Times CrashClient against a local stub of the crash api
+    """
+    server = serve_in_background(delay=delay, fail_every=fail_every)
+    url = f"http://localhost:{server.server_address[1]}/summary"
+    rng = random.Random(0)
+    geometries = {}
+    for index in range(count):
+        polygons = []
+        for _ in range(parts):
+            x, y = -75.2 + rng.random() * 0.2, 39.9 + rng.random() * 0.1
+            ring = [[x, y], [x + 0.001, y], [x + 0.001, y + 0.001], [x, y + 0.001]]
+            polygons.append([ring + [ring[0]]])
+        geometries[index] = {"type": "MultiPolygon", "coordinates": polygons}
+
+    results, reference = {}, None
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, client in [
+            ("sequential", CrashClient(url, workers=1, cache_dir=None)),
+            ("concurrent_cold", CrashClient(url, workers=workers, cache_dir=cache_dir)),
+            ("concurrent_warm", CrashClient(url, workers=workers, cache_dir=cache_dir)),
+        ]:
+            served = server.requests
+            start = time.perf_counter()
+            totals = client.totals_by_id(geometries)
+            results[name] = {
+                "seconds": round(time.perf_counter() - start, 4),
+                "requests": server.requests - served,
+                **client.stats(),
+            }
+            reference = reference or totals
+            if totals != reference:
+                raise click.ClickException(f"{name} totals differ from sequential")
+    server.shutdown()
+    click.echo(json.dumps(results, indent=2))
+
+
+@main.command()
+@click.argument("before")
+@click.argument("after")
+def compare(before, after):
+    """
+    Compares the median timings of two results files
+    """
+    with open(before) as f:
+        before = json.load(f)
+    with open(after) as f:
+        after = json.load(f)
+
+    rows = [
+        (
+            "segment",
+            before["summary"]["segment_seconds"],
+            after["summary"]["segment_seconds"],
+        )
+    ]
+    for stage, summary in after["summary"]["stages"].items():
+        if stage in before["summary"]["stages"]:
+            rows.append((stage, before["summary"]["stages"][stage], summary))
+
+    click.echo(
+        f"{'':45}{str(before['commit']):>12}{str(after['commit']):>12}{'change':>10}"
+    )
+    for name, old, new in rows:
+        change = (new["median"] - old["median"]) / old["median"] if old["median"] else 0
+        click.echo(
+            f"{name:45}{old['median']:>12.4f}{new['median']:>12.4f}{change:>+10.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
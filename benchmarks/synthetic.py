@@ -0,0 +1,240 @@
+"""
+synthetic.py
+------------------
+Generates a synthetic region for benchmarking, at a configurable scale.
+
+Every source table StudySegment reads is created in the target database (the
+low stress networks, islands and topology are built from them by `load`, see
+network_islands.build_all): an LTS and a sidewalk network (a regular grid, or an "organic" one with jittered nodes and
+missing links), census tract and LODES polygons, land use parcels, essential
+services, rail stations and circuit trails. Data is generated inside PostGIS
+with a fixed seed, so the same scale always produces the same region.
+
+"""
+
+import random
+
+# projected coordinates near Philadelphia, EPSG:26918
+ORIGIN = (485000, 4420000)
+
+LAND_USES = [
+    "Parking: Surface",
+    "Institutional: School",
+    "Commercial: Retail",
+    "Recreation: General",
+    "Transportation: Facility",
+    "Transportation: Rail Right-of-Way",
+    "Residential: Single-Family Detached",
+    "Residential: Multi-Family",
+    "Wooded",
+    "Agriculture",
+]
+
+SERVICES = ["School", "Grocery Store", "Health Facility", "Library", "Park"]
+
+
+def _network_sql(
+    table: str,
+    id_column: str,
+    extra_columns: str,
+    grid_size: int,
+    spacing: float,
+    organic: bool,
+    offset: float = 0,
+):
+    """Select of a grid network, jittered and with missing links when organic"""
+    jitter = 0.6 * spacing if organic else 0
+    drop = 0.15 if organic else 0
+    return f"""
+        create table {table} as
+        with nodes as (
+            select i, j,
+                {ORIGIN[0] + offset} + i * {spacing} + (random() - 0.5) * {jitter} as x,
+                {ORIGIN[1] + offset} + j * {spacing} + (random() - 0.5) * {jitter} as y
+            from generate_series(0, {grid_size - 1}) i, generate_series(0, {grid_size - 1}) j
+        ),
+        edges as (
+            select a.x as x1, a.y as y1, b.x as x2, b.y as y2
+            from nodes a
+            inner join nodes b
+            on (b.i = a.i + 1 and b.j = a.j) or (b.i = a.i and b.j = a.j + 1)
+        )
+        select
+            row_number() over () as {id_column},
+            {extra_columns},
+            st_setsrid(st_makeline(st_makepoint(x1, y1), st_makepoint(x2, y2)), 26918) as geom
+        from edges
+        where random() >= {drop};
+        create index on {table} using gist (geom);
+    """
+
+
+def _polygon_grid_sql(table: str, columns: str, cells: int, extent: float):
+    """Select of a grid of square polygons covering the region"""
+    size = extent / cells
+    return f"""
+        create table {table} as
+        select
+            {columns},
+            st_makeenvelope(
+                {ORIGIN[0]} + i * {size}, {ORIGIN[1]} + j * {size},
+                {ORIGIN[0]} + (i + 1) * {size}, {ORIGIN[1]} + (j + 1) * {size},
+                26918
+            ) as geom
+        from generate_series(0, {cells - 1}) i, generate_series(0, {cells - 1}) j;
+        create index on {table} using gist (geom);
+    """
+
+
+def _points_sql(table: str, columns: str, count: int, extent: float):
+    """Select of points scattered over the region"""
+    return f"""
+        create table {table} as
+        select
+            {columns},
+            st_setsrid(st_makepoint(
+                {ORIGIN[0]} + random() * {extent}, {ORIGIN[1]} + random() * {extent}
+            ), 26918) as geom
+        from generate_series(1, {count});
+        create index on {table} using gist (geom);
+    """
+
+
+def generate_region(
+    db,
+    grid_size: int = 60,
+    spacing: float = 100,
+    organic: bool = False,
+    seed: float = 0.42,
+):
+    """
+    Creates every table used by StudySegment in db, replacing existing ones.
+    Islands and topology still have to be built with network_islands.py.
+
+    :param int grid_size: nodes along each side of the network grid
+    :param float spacing: meters between grid nodes
+    :param bool organic: jitter nodes and drop ~15% of links instead of a regular grid
+    :param float seed: seed for postgres' random(), between -1 and 1
+    """
+    extent = grid_size * spacing
+    lts_score = "(array[1, 1, 2, 2, 3, 4])[1 + floor(random() * 6)::int] as lts_score"
+    demographics = ", ".join(
+        f"floor(random() * 3000)::int as {column}"
+        for column in [
+            "disabled",
+            "ethnic_minority",
+            "female",
+            "foreign_born",
+            "lep",
+            "low_income",
+            "older_adult",
+            "racial_minority",
+            "youth",
+        ]
+    )
+    land_uses = ", ".join(f"'{lu}'" for lu in LAND_USES)
+    services = ", ".join(f"'{service}'" for service in SERVICES)
+
+    print(f"generating synthetic region, {extent / 1000} km across, please wait..")
+
+    db.execute(
+        f"""
+        select setseed({seed});
+        create extension if not exists postgis;
+        create extension if not exists pgrouting;
+        drop schema if exists lts cascade;
+        create schema lts;
+        drop schema if exists sidewalk cascade;
+        create schema sidewalk;
+        drop table if exists censustract2020_demographics, lodes_2020,
+            landuse_2015, essential_services, passengerrailstations, circuittrails;
+        {_network_sql("lts.lts_full", "dvrpc_id", lts_score, grid_size, spacing, organic)}
+        {_network_sql(
+            "sidewalk.ped_network",
+            "objectid",
+            "'SIDEWALK'::varchar as feat_type",
+            grid_size,
+            spacing,
+            organic,
+            offset=spacing / 2,
+        )}
+        {_polygon_grid_sql(
+            "censustract2020_demographics",
+            f"{demographics}, case when random() < 0.02 then -666666666 else floor(random() * 8000)::int end as total_pop",
+            max(grid_size // 10, 1),
+            extent,
+        )}
+        {_polygon_grid_sql(
+            "lodes_2020",
+            "floor(random() * 5000)::int as total_jobs",
+            max(grid_size // 10, 1),
+            extent,
+        )}
+        {_polygon_grid_sql(
+            "landuse_2015",
+            f"(array[{land_uses}])[1 + floor(random() * {len(LAND_USES)})::int] as lu15subn",
+            grid_size * 2,
+            extent,
+        )}
+        {_points_sql(
+            "essential_services",
+            f"(array[{services}])[1 + floor(random() * {len(SERVICES)})::int] as type",
+            grid_size * 5,
+            extent,
+        )}
+        {_points_sql(
+            "passengerrailstations",
+            "'Regional Rail'::varchar as type",
+            max(grid_size // 5, 1),
+            extent,
+        )}
+        create table circuittrails as
+        select
+            (array['Existing', 'Planned', 'In Progress'])[1 + floor(random() * 3)::int] as circuit,
+            st_setsrid(st_makeline(
+                st_makepoint({ORIGIN[0]} + x * {extent}, {ORIGIN[1]}),
+                st_makepoint({ORIGIN[0]} + x * {extent}, {ORIGIN[1] + extent})
+            ), 26918) as geom
+        from (select random() as x from generate_series(1, {max(grid_size // 10, 1)})) t;
+        create index on circuittrails using gist (geom);
+        """
+    )
+
+
+def random_segments(
+    db,
+    count: int,
+    grid_size: int = 60,
+    spacing: float = 100,
+    seed: int = 42,
+    name_prefix: str = "bench",
+):
+    """
+    Returns count geojson features of straight lines between 300m and 1.5km long,
+    inside the synthetic region, in EPSG:4326 like a drawn study segment.
+    """
+    rng = random.Random(seed)
+    extent = grid_size * spacing
+    values = []
+    for _ in range(count):
+        length = rng.uniform(300, min(1500, extent / 2))
+        x1 = ORIGIN[0] + rng.uniform(0, extent - length)
+        y1 = ORIGIN[1] + rng.uniform(0, extent - length)
+        x2, y2 = (x1 + length, y1) if rng.random() < 0.5 else (x1, y1 + length)
+        values.append(f"({x1}, {y1}, {x2}, {y2})")
+
+    rows = db.query(
+        f"""
+        select st_asgeojson(st_transform(st_setsrid(
+            st_makeline(st_makepoint(x1, y1), st_makepoint(x2, y2)), 26918), 4326))::json
+        from (values {", ".join(values)}) v(x1, y1, x2, y2)
+        """
+    )
+    return [
+        {
+            "type": "Feature",
+            "properties": {"name": f"{name_prefix} {index}"},
+            "geometry": row[0],
+        }
+        for index, row in enumerate(rows)
+    ]
@@ -1,3 +1,24 @@
 from .connections import StudySegment, SegmentNameConflictError
+from .async_segment import AsyncStudySegment
+from .batch import BatchStudySegments
+from .cache import ResultCache, get_result_cache
+from .instrumentation import Instrumentation
+from .island_graph import IslandGraph
+from .pool import get_database, pool_stats
+from .scenarios import ScenarioAnalyzer
 
-__all__ = ["connections"]
+__all__ = [
+    "connections",
+    "batch",
+    "StudySegment",
+    "SegmentNameConflictError",
+    "AsyncStudySegment",
+    "BatchStudySegments",
+    "ResultCache",
+    "get_result_cache",
+    "Instrumentation",
+    "IslandGraph",
+    "get_database",
+    "pool_stats",
+    "ScenarioAnalyzer",
+]
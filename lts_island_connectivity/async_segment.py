@@ -0,0 +1,198 @@
+"""
+async_segment.py
+------------------
+StudySegment for asyncio applications.
+
+Once a segment's blob or isochrone exists, its stats are independent reads of
+different tables. AsyncStudySegment builds the study area with StudySegment in
+a worker thread, so the event loop keeps serving other requests, then issues
+every read of SEGMENT_STATS at once on an asyncpg pool and gathers them, so
+pulling stats takes about as long as the slowest overlay. Writing the overlay
+SQL can query the database (see overlays.subdivided), so it's done once per
+segment in a worker thread too, and the loop only awaits asyncpg.
+
+    segment = await AsyncStudySegment.create("lts", feature, "username")
+    segment.total_pop
+
+Needs the async extra: pip install lts-island-connectivity[async]. asyncpg
+caches its own prepared statements per connection, so queries aren't wrapped in
+PREPARE here. Engines are tied to the event loop that first used them, as
+asyncio engines are, so use one loop per process (as FastAPI does).
+
+"""
+
+import asyncio
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from .connections import (
+    SEGMENT_STATS,
+    StudySegment,
+    rounded,
+    stat_query,
+    stats_query,
+    study_area,
+)
+from .settings import POOL_SIZE, MAX_OVERFLOW, PULL_CRASHES
+
+_async_engines = {}
+
+
+def get_async_engine(uri: str, pool_size: int = None, max_overflow: int = None):
+    """Returns the shared asyncpg engine for a uri, creating it on first use"""
+    if uri not in _async_engines:
+        try:
+            from sqlalchemy.ext.asyncio import create_async_engine
+        except ImportError as e:
+            raise ImportError(
+                "AsyncStudySegment needs the async extra, "
+                "pip install lts-island-connectivity[async]"
+            ) from e
+        _async_engines[uri] = create_async_engine(
+            make_url(uri).set(drivername="postgresql+asyncpg"),
+            pool_size=pool_size or POOL_SIZE,
+            max_overflow=max_overflow if max_overflow is not None else MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+    return _async_engines[uri]
+
+
+class AsyncDatabase:
+    """
+    Read-only async counterpart of PooledDatabase. Each call checks its own
+    connection out of the pool, so concurrent calls run in parallel.
+    """
+
+    def __init__(self, uri: str, pool_size: int = None, max_overflow: int = None):
+        self.uri = uri
+        self.engine = get_async_engine(uri, pool_size, max_overflow)
+
+    async def query(self, query, params: dict = None):
+        async with self.engine.connect() as connection:
+            result = await connection.execute(text(str(query)), params or {})
+            return [tuple(row) for row in result]
+
+    async def query_as_singleton(self, query, params: dict = None):
+        return (await self.query(query, params))[0][0]
+
+    async def records(self, query, params: dict = None):
+        """Rows as dicts, like PooledDatabase.df(...).to_dict("records")"""
+        async with self.engine.connect() as connection:
+            result = await connection.execute(text(str(query)), params or {})
+            return [dict(row) for row in result.mappings()]
+
+
+class AsyncStudySegment:
+    """
+    A StudySegment whose stats are pulled concurrently. Build it with create(),
+    which takes the arguments of StudySegment. The StudySegment is kept as
+    .segment, and its attributes can be read off this object directly.
+    """
+
+    def __init__(self, segment: StudySegment, db: AsyncDatabase) -> None:
+        self.segment = segment
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.segment, name)
+
+    @classmethod
+    async def create(
+        cls,
+        network_type: str,
+        feature: dict,
+        username: str,
+        highest_comfort_level: int = 2,
+        overwrite: bool = False,
+        pg_config_filepath: str = None,
+        **kwargs,
+    ):
+        segment = await asyncio.to_thread(
+            StudySegment,
+            network_type,
+            feature,
+            username,
+            highest_comfort_level,
+            overwrite,
+            pg_config_filepath,
+            defer_stats=True,
+            **kwargs,
+        )
+        self = cls(segment, AsyncDatabase(segment.db.uri))
+        if segment.stats_pending:
+            stats = await self.pull_segment_stats()
+            await asyncio.to_thread(segment.complete_stats, stats)
+        return self
+
+    def stat_queries(self):
+        """
+        Returns the SQL of every read of SEGMENT_STATS, keyed by attribute. Runs
+        synchronous queries, call it in a worker thread.
+        """
+        queries = {}
+        for attribute, column, table, geom_type in SEGMENT_STATS:
+            if geom_type == "polygons":
+                polygon = study_area(self.results_schema, self.has_isochrone)
+                queries[attribute] = stats_query(
+                    self.segment.db, column, table, polygon
+                )
+            else:
+                polygon = study_area(self.results_schema, self.has_isochrone, table)
+                queries[attribute] = stat_query(
+                    self.segment.db, column, table, geom_type, polygon
+                )
+        return queries
+
+    async def pull_segment_stats(self):
+        """Pulls every stat of SEGMENT_STATS, and crashes with PULL_CRASHES, at once"""
+        print("pulling every stat at once, please wait..")
+        queries = await asyncio.to_thread(self.stat_queries)
+        attributes, reads = [], []
+        for attribute, column, table, geom_type in SEGMENT_STATS:
+            attributes.append(attribute)
+            if geom_type == "polygons":
+                reads.append(self.pull_stats(column, table, queries[attribute]))
+            else:
+                reads.append(
+                    self.pull_stat(column, table, geom_type, queries[attribute])
+                )
+        if PULL_CRASHES:
+            attributes.append("bike_ped_crashes")
+            reads.append(self.pull_crashes())
+
+        instrumentation = self.segment.instrumentation
+        if instrumentation is None:
+            values = await asyncio.gather(*reads)
+        else:
+            with instrumentation.stage("pull_stats:concurrent"):
+                values = await asyncio.gather(*reads)
+        return dict(zip(attributes, values))
+
+    async def pull_crashes(self):
+        """StudySegment.pull_crashes, in a worker thread"""
+        crashes = await asyncio.to_thread(
+            self.segment.pull_crashes, self.study_segment_id
+        )
+        return crashes[0]
+
+    async def pull_stat(self, column: str, table: str, geom_type: str, q: str = None):
+        """Async StudySegment.pull_stat, q is its SQL when already written"""
+        if q is None:
+            polygon = study_area(self.results_schema, self.has_isochrone, table)
+            q = await asyncio.to_thread(
+                stat_query, self.segment.db, column, table, geom_type, polygon
+            )
+        params = {"id": self.study_segment_id}
+
+        if geom_type.lower() == "polygon":
+            return rounded(await self.db.query_as_singleton(q, params))
+        return await self.db.records(q, params)
+
+    async def pull_stats(self, columns: list, table: str, q: str = None):
+        """Async StudySegment.pull_stats, q is its SQL when already written"""
+        if q is None:
+            polygon = study_area(self.results_schema, self.has_isochrone)
+            q = await asyncio.to_thread(
+                stats_query, self.segment.db, columns, table, polygon
+            )
+        sums = (await self.db.query(q, {"id": self.study_segment_id}))[0]
+        return {column: rounded(value) for column, value in zip(columns, sums)}
@@ -0,0 +1,659 @@
+"""
+batch.py
+------------------
+Scores a whole FeatureCollection in one pass.
+
+Every feature is loaded into a staging table, and each stage of the
+StudySegment pipeline (buffers, islands, blobs, parking lots, stats) runs once
+as a set-based query keyed by segment id, instead of once per feature.
+The user_* rows written are the same as the per-feature path.
+
+"""
+
+import json
+import re
+import uuid
+from collections import defaultdict
+import requests
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from .connections import (
+    DEMOGRAPHIC_COLUMNS,
+    SegmentNameConflictError,
+    geometry_to_wkt,
+    apply_summaries,
+    network_tables,
+)
+from .crashes import NO_CRASHES, get_crash_client
+from .islands import METERS_PER_MILE
+from .overlays import intersecting, overlay
+from .pool import get_database
+from .routing import isochrone_radius, reachable_nodes
+from .schema import ensure_schema
+from .settings import PULL_CRASHES
+from .statements import prepared
+
+
+class BatchStudySegments:
+    def __init__(
+        self,
+        network_type: str,
+        features,
+        username: str,
+        highest_comfort_level: int = 2,
+        overwrite: bool = False,
+        pg_config_filepath: str = None,
+        override_isochrone_flag: bool = True,
+        routing_engine: str = "pgrouting",
+    ) -> None:
+        self.db = get_database("localhost", pg_config_filepath)
+        self.network_type = network_type
+        self.override_isochrone_flag = override_isochrone_flag
+        self.routing_engine = routing_engine
+        segment_tablenames = network_tables(network_type, highest_comfort_level)
+        self.highest_comfort_level = segment_tablenames[0]
+        self.ls_table = segment_tablenames[1]
+        self.ids = segment_tablenames[2]
+        self.nodes_table = segment_tablenames[3]
+        self.username = username
+        self.overwrite = overwrite
+        self.batch_id = uuid.uuid4().hex
+        self.staging_table = f"{self.network_type}.user_segments_staging"
+
+        ensure_schema(self.db, self.network_type)
+        try:
+            if not self.__stage_features(features):
+                print("no features to score.")
+                return
+            self.__create_study_segments()
+            self.__buffer_study_segments()
+            self.__generate_proximate_islands()
+            self.miles = self.__generate_mileage()
+            self.__decide_scope()
+            self.__generate_proximate_blobs()
+            self.__handle_parking_lots()
+            self.__update_mileage()
+
+            self.stats = defaultdict(dict)
+            demographics = self.pull_stats(
+                DEMOGRAPHIC_COLUMNS, "censustract2020_demographics"
+            )
+            for column in DEMOGRAPHIC_COLUMNS:
+                self.__collect(column, demographics[column])
+            self.__collect("circuit", self.pull_stat("circuit", "circuittrails", "line"))
+            self.__collect(
+                "total_jobs", self.pull_stat("total_jobs", "lodes_2020", "polygon")
+            )
+            self.__collect(
+                "essential_services",
+                self.pull_stat("type", "essential_services", "point"),
+            )
+            self.__collect(
+                "rail_stations",
+                self.pull_stat("type", "passengerrailstations", "point"),
+            )
+            if PULL_CRASHES:
+                self.__collect("bike_ped_crashes", self.pull_crashes())
+            self.summarize_stats()
+        finally:
+            self.db.execute(
+                f"delete from {self.staging_table} where batch_id = :batch_id",
+                self.__params(),
+            )
+
+    def __sanitize_name(self, properties: dict):
+        """Remove non-standard characters from the segment name"""
+        segment_name = properties.get("name") or properties.get("Name")
+        return re.sub(r"[^a-zA-Z0-9 ]", "", segment_name)
+
+    def __stage_features(self, features, chunk_size: int = 500):
+        """
+        Loads features into the staging table in chunks, so a streamed input is
+        never held in memory all at once. Later features with the same name replace
+        earlier ones, the same as running each with overwrite.
+        Returns the number of segments staged.
+        """
+        db_segments = self.db.query(
+            prepared(
+                f"select seg_name from {self.network_type}.user_segments where username = :username"
+            ),
+            {"username": self.username},
+        )
+        flat_segs = {item for sublist in db_segments for item in sublist}
+
+        print("staging segments, please wait..")
+
+        insert = text(
+            f"""
+            INSERT INTO {self.staging_table}
+            (batch_id, feature_index, username, seg_name, geom)
+            VALUES (:batch_id, :feature_index, :username, :seg_name,
+                ST_Transform(ST_GeomFromText(:geom, 4326), 26918))
+            """
+        )
+        Session = sessionmaker(bind=self.db.engine)
+        session = Session()
+
+        names = set()
+        chunk = []
+        for index, feature in enumerate(features):
+            seg_name = self.__sanitize_name(feature["properties"])
+            if not self.overwrite and (seg_name in names or seg_name in flat_segs):
+                session.rollback()
+                raise SegmentNameConflictError("Project name already used.")
+            names.add(seg_name)
+            chunk.append(
+                {
+                    "batch_id": self.batch_id,
+                    "feature_index": index,
+                    "username": self.username,
+                    "seg_name": seg_name,
+                    "geom": geometry_to_wkt(feature["geometry"]),
+                }
+            )
+            if len(chunk) >= chunk_size:
+                session.execute(insert, chunk)
+                chunk = []
+        if chunk:
+            session.execute(insert, chunk)
+
+        session.execute(
+            text(
+                f"""
+                DELETE FROM {self.staging_table} a
+                USING {self.staging_table} b
+                WHERE a.batch_id = :batch_id
+                AND b.batch_id = :batch_id
+                AND a.seg_name = b.seg_name
+                AND a.feature_index < b.feature_index
+                """
+            ),
+            {"batch_id": self.batch_id},
+        )
+        session.commit()
+
+        print(f"staged {len(names)} segments.")
+        return len(names)
+
+    def __create_study_segments(self):
+        """
+        Creates a user_segments row for every staged feature, then records the new
+        ids back on the staging table.
+        """
+        if self.overwrite:
+            self.db.execute(
+                f"""
+                DELETE FROM {self.network_type}.user_segments a
+                USING {self.staging_table} s
+                WHERE s.batch_id = :batch_id
+                AND a.seg_name = s.seg_name
+                AND a.username = s.username
+                """,
+                self.__params(),
+            )
+
+        self.db.execute(
+            f"""
+            INSERT INTO {self.network_type}.user_segments
+            (username, seg_name, geom)
+            SELECT username, seg_name, geom
+            FROM {self.staging_table}
+            WHERE batch_id = :batch_id
+            ORDER BY feature_index;
+            UPDATE {self.staging_table} s
+            SET segment_id = a.id
+            FROM {self.network_type}.user_segments a
+            WHERE s.batch_id = :batch_id
+            AND a.seg_name = s.seg_name
+            AND a.username = s.username;
+            """,
+            self.__params(),
+        )
+        self.segments = dict(
+            self.db.query(
+                f"""
+                select segment_id, seg_name from {self.staging_table}
+                where batch_id = :batch_id
+                order by feature_index
+                """,
+                self.__params(),
+            )
+        )
+
+    def __staged(self, id_column: str):
+        """
+        Join clause restricting a stage to this batch's segments, aliased as s.
+        Queries using it take __params()
+        """
+        return f"""
+            inner join {self.staging_table} s
+            on s.segment_id = {id_column}
+            and s.batch_id = :batch_id
+        """
+
+    def __params(self, **params):
+        """Bind parameters of a query restricted to this batch, plus params"""
+        return {"batch_id": self.batch_id, **params}
+
+    def __buffer_study_segments(self, distance: int = 30):
+        """Creates the 30m buffer around every study segment in the batch"""
+
+        self.db.execute(
+            f"""
+                insert into {self.network_type}.user_buffers
+                select a.id, a.username, st_buffer(a.geom, {distance}) as geom
+                from {self.network_type}.user_segments a
+                {self.__staged("a.id")}
+            """,
+            self.__params(),
+        )
+
+    def __generate_proximate_islands(self):
+        """Finds islands proximate to every segment buffer in the batch"""
+
+        print("generating proximate islands, please wait..")
+
+        self.db.execute(
+            f"""
+                insert into {self.network_type}.user_islands
+                    select
+                        a.id,
+                        a.username,
+                        st_collectionextract(st_collect(b.geom)) as geom,
+                        sum(b.size_miles)
+                    from {self.network_type}.user_buffers a
+                    inner join {self.network_type}.{self.network_type}{self.highest_comfort_level}_islands b
+                    on st_intersects(a.geom,b.geom)
+                    {self.__staged("a.id")}
+                    group by a.id
+            """,
+            self.__params(),
+        )
+
+    def __generate_mileage(self):
+        """Returns the mileage of the proximate islands for every segment"""
+
+        print("calculating mileage of proximate islands, please wait..")
+
+        rows = self.db.query(
+            f"""
+            select s.segment_id, coalesce(a.size_miles, 0.0)
+            from {self.staging_table} s
+            left join {self.network_type}.user_islands a
+            on a.id = s.segment_id
+            where s.batch_id = :batch_id
+            """,
+            self.__params(),
+        )
+        return {segment_id: miles for segment_id, miles in rows}
+
+    def __decide_scope(self, mileage: int = 300):
+        """
+        Flags segments whose connected islands are above the mileage threshold and
+        creates their isochrones. pgr_drivingDistance runs once per segment here, as
+        each segment has its own set of start nodes.
+        """
+        self.has_isochrone = {
+            segment_id: miles > mileage for segment_id, miles in self.miles.items()
+        }
+        isochrone_ids = [k for k, v in self.has_isochrone.items() if v]
+
+        if isochrone_ids and not self.override_isochrone_flag:
+            raise ValueError(
+                f"Isochrone flag error: segment@{self.segments[isochrone_ids[0]]}"
+            )
+
+        self.db.execute(
+            f"""
+            update {self.staging_table}
+            set has_isochrone = segment_id = any(CAST(:ids AS integer[]))
+            where batch_id = :batch_id
+            """,
+            self.__params(ids=isochrone_ids),
+        )
+
+        for segment_id in isochrone_ids:
+            print(
+                f"mileage of nearby islands > {mileage}, creating isochrone for {self.segments[segment_id]}"
+            )
+            self.__create_isochrone(segment_id)
+
+    def __create_isochrone(self, segment_id: int, travel_time: int = 15):
+        """Creates isochrone for one segment of the batch"""
+
+        if self.routing_engine == "python":
+            nodes = """nodes AS (
+                SELECT unnest(CAST(:nodes AS integer[])) AS node
+            ),"""
+            params = {
+                "id": segment_id,
+                "nodes": reachable_nodes(
+                    self.db,
+                    self.network_type,
+                    self.ls_table,
+                    self.nodes_table,
+                    segment_id,
+                    travel_time,
+                ),
+            }
+        else:
+            radius = isochrone_radius(
+                self.db, self.network_type, self.ls_table, travel_time
+            )
+            nodes = f"""nodes AS (
+                SELECT *
+                FROM pgr_drivingDistance(
+                    format(
+                        'SELECT {self.ids} as id, source, target, traveltime_min as cost FROM {self.network_type}.{self.ls_table} WHERE geom && %L::geometry',
+                        (SELECT ST_Expand(ST_Collect(a.geom), {radius}) FROM {self.network_type}.{self.nodes_table} a
+                         INNER JOIN {self.network_type}.{self.ls_table} b ON a.id = b."source"
+                         WHERE b.{self.ids}= ANY((SELECT ids FROM arrays)::integer[]))
+                    ),
+                    (SELECT array_agg("source") FROM {self.network_type}.{self.nodes_table} a
+                     INNER JOIN {self.network_type}.{self.ls_table} b ON a.id = b."source"
+                     WHERE b.{self.ids}= ANY((SELECT ids FROM arrays)::integer[])),
+                    {travel_time}, false
+                ) AS di
+                JOIN {self.network_type}.{self.nodes_table} pt ON di.node = pt.id
+            ),"""
+            params = {"id": segment_id}
+
+        self.db.execute(
+            prepared(
+                f"""
+                insert into {self.network_type}.user_isochrones
+                WITH arrays AS (
+                    select a.id as id,
+                    a.username,
+                    array_agg(c.{self.ids}) as ids
+                    FROM {self.network_type}.user_segments a
+                    INNER JOIN {self.network_type}.user_buffers b ON a.id = b.id
+                    INNER JOIN {self.network_type}.{self.ls_table} c ON st_intersects(b.geom, c.geom)
+                    WHERE a.id = :id
+                    group by a.id
+                ),
+                {nodes}
+                node_buffer as (
+                    select ST_Union(ST_Buffer(pt.geom, 1000)) AS geom
+                    from nodes n
+                    join {self.network_type}.{self.nodes_table} pt ON n.node = pt.id
+                )
+                select (select id from arrays) as id, (select username from arrays), st_union(st_buffer(a.geom, 100)) as geom, round(st_length(st_union(a.geom))/{METERS_PER_MILE}) as miles
+                    from {self.network_type}.{self.ls_table} a
+                    where st_intersects(a.geom, (select geom from node_buffer));
+                """
+            ),
+            params,
+        )
+
+    def __generate_proximate_blobs(self):
+        """
+        Creates blobs for every segment in the batch that has no isochrone, from the
+        precomputed island buffers. See StudySegment for details.
+        """
+        islands = f"{self.network_type}.{self.network_type}{self.highest_comfort_level}_islands"
+
+        self.db.execute(
+            f"""
+                insert into {self.network_type}.user_blobs
+                select c.id, c.username, st_union(i.geom, c.geom) as geom
+                from {self.network_type}.user_buffers c
+                {self.__staged("c.id")}
+                cross join lateral (
+                    select st_union(b.geom) as geom
+                    from {islands} a
+                    inner join {islands}_buffers b
+                    on a.uid = b.uid
+                    where st_intersects(c.geom, a.geom)
+                ) as i
+                where not s.has_isochrone
+                and i.geom is not null
+            """,
+            self.__params(),
+        )
+
+    def __handle_parking_lots(self):
+        """
+        Folds proximate parking lots and their associated land uses into the blob or
+        isochrone of every segment in the batch. See StudySegment for details.
+        """
+        print("folding in proximate parking lots and associated lu's, please wait..")
+
+        for join_table, has_isochrone in [
+            (f"{self.network_type}.user_isochrones", "true"),
+            (f"{self.network_type}.user_blobs", "false"),
+        ]:
+            self.db.execute(
+                f"""
+                WITH proximate_lu AS (
+                    SELECT a.geom, c.id, a.lu15subn
+                    FROM {self.network_type}.user_buffers b
+                    INNER JOIN {self.network_type}.user_segments c
+                    ON b.id = c.id
+                    {self.__staged("c.id")}
+                    CROSS JOIN {intersecting(self.db, "landuse_2015", "b.geom")} a
+                    WHERE s.has_isochrone = {has_isochrone}
+                    AND (
+                        a.lu15subn LIKE 'Parking%'
+                        OR a.lu15subn LIKE 'Institutional%'
+                        OR a.lu15subn LIKE 'Commercial%'
+                        OR a.lu15subn = 'Recreation: General'
+                        OR a.lu15subn = 'Transportation: Rail Right-of-Way'
+                        OR a.lu15subn = 'Transportation: Facility')
+                ),
+                proximate_lu_and_touching AS (
+                    SELECT a.id, st_collect(b.geom, a.geom) as geom
+                    FROM proximate_lu a
+                    CROSS JOIN {intersecting(self.db, "landuse_2015", "a.geom")} b
+                    Where ST_Touches(a.geom, b.geom)
+                    AND (
+                        b.lu15subn LIKE 'Parking%'
+                        OR b.lu15subn LIKE 'Institutional%'
+                        OR b.lu15subn LIKE 'Commercial%'
+                        OR b.lu15subn = 'Recreation: General'
+                        OR b.lu15subn = 'Transportation: Rail Right-of-Way'
+                        OR b.lu15subn = 'Transportation: Facility')
+                )
+                UPDATE {join_table} AS b
+                SET geom = ST_Union(a.geom, b.geom)
+                from proximate_lu_and_touching a
+                where b.id = a.id
+                """,
+                self.__params(),
+            )
+
+    def __update_mileage(self):
+        """Replaces island mileage with isochrone mileage where an isochrone exists"""
+
+        rows = self.db.query(
+            f"""
+            select a.id, a.miles from {self.network_type}.user_isochrones a
+            {self.__staged("a.id")}
+            where s.has_isochrone
+            """,
+            self.__params(),
+        )
+        for segment_id, miles in rows:
+            self.miles[segment_id] = miles
+
+    def __study_areas(self):
+        """Subquery of the blob or isochrone polygon of every segment in the batch"""
+        return f"""(
+            select a.id, a.geom from {self.network_type}.user_isochrones a
+            {self.__staged("a.id")}
+            where s.has_isochrone
+            union all
+            select a.id, a.geom from {self.network_type}.user_blobs a
+            {self.__staged("a.id")}
+            where not s.has_isochrone
+        )"""
+
+    def __collect(self, key: str, values: dict):
+        for segment_id in self.segments:
+            self.stats[segment_id][key] = values.get(segment_id)
+
+    def pull_stat(self, column: str, table: str, geom_type: str):
+        """
+        grabs the identified attribute within the study area of every segment in the
+        batch, returned as a dict keyed by segment id. Values match
+        StudySegment.pull_stat.
+
+        :param str column: the column you want to pull data from in your database
+        :param str table: the table you want to pull data from in your database
+        :param str geom_type: the type (point, line, or polygon) of your data, ie what is in the polygon shape.
+        """
+
+        print(f"pulling stat from {table} table for all segments, please wait..")
+
+        polygon = self.__study_areas()
+        geom_type = geom_type.lower()
+
+        if geom_type == "polygon":
+            rows = self.db.query(
+                f"""
+                with total as(
+                    select a.id, round(a.ratio * a.{column}) as {column}_in_blobs
+                    from {overlay(self.db, table, [column], polygon)} a
+                    where a.{column} >= 0)
+                select id, round(sum({column}_in_blobs)) from total
+                group by id
+                """,
+                self.__params(),
+            )
+            return {
+                segment_id: None if value is None else int(round(value, -2))
+                for segment_id, value in rows
+            }
+
+        if geom_type == "point":
+            df = self.db.df(
+                f"""select b.id, count(a.{column}), a.{column} from {table} a, {polygon} b
+                    where st_intersects(a.geom, b.geom)
+                    group by b.id, a.{column}""",
+                self.__params(),
+            )
+            values = defaultdict(list)
+            for record in df.to_dict("records"):
+                values[record.pop("id")].append(record)
+            return {k: values.get(k, []) for k in self.segments}
+
+        if geom_type == "line":
+            df = self.db.df(
+                f"""
+                select
+                    id,
+                    {column},
+                    sum(miles) as miles
+                from (
+                    select
+                        b.id,
+                        a.{column},
+                        st_length(a.geom)/{METERS_PER_MILE} as miles
+                    from
+                        {table} a,
+                        {polygon} b
+                    where
+                        st_intersects(a.geom, b.geom)
+                ) as subquery
+                group by
+                    id, {column};
+                """,
+                self.__params(),
+            )
+            values = defaultdict(list)
+            for record in df.to_dict("records"):
+                values[record.pop("id")].append(record)
+            return {k: values.get(k, []) for k in self.segments}
+
+    def pull_stats(self, columns: list, table: str):
+        """
+        grabs several attributes of a polygon table within the study area of every
+        segment in one overlay, returned as a dict of column: {segment id: value}.
+        values match StudySegment.pull_stats.
+
+        :param list columns: the columns you want to pull data from in your database
+        :param str table: the table you want to pull data from in your database
+        """
+
+        print(
+            f"pulling {len(columns)} stats from {table} table for all segments, please wait.."
+        )
+
+        apportioned = ", ".join(
+            f"round(sum(case when {column} >= 0 then round(ratio * {column}) end))"
+            for column in columns
+        )
+        rows = self.db.query(
+            f"""
+            with total as(
+                select * from {overlay(self.db, table, columns, self.__study_areas())} a)
+            select id, {apportioned} from total
+            group by id
+            """,
+            self.__params(),
+        )
+
+        values = {column: {} for column in columns}
+        for segment_id, *sums in rows:
+            for column, value in zip(columns, sums):
+                values[column][segment_id] = (
+                    None if value is None else int(round(value, -2))
+                )
+        return values
+
+    def pull_crashes(self):
+        """
+        grabs bike and pedestrian crash totals from DVRPC's crash API for the buffer
+        of every segment, returned as a dict keyed by segment id. The polygons of
+        all the buffers are fetched at once, see crashes.py.
+        """
+
+        print("pulling crashes for all segments, please wait..")
+
+        rows = self.db.query(
+            f"""
+            select a.id, st_asgeojson(st_transform(st_union(a.geom), 4326))
+            from {self.network_type}.user_buffers a
+            {self.__staged("a.id")}
+            group by a.id
+            """,
+            self.__params(),
+        )
+        try:
+            return get_crash_client().totals_by_id(
+                {segment_id: json.loads(geojson) for segment_id, geojson in rows}
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"error with crash api: {e}")
+            return {segment_id: "error with crash api" for segment_id, _ in rows}
+
+    def summarize_stats(self):
+        """Writes the summary columns for every segment in the batch at once"""
+
+        summaries = []
+        for segment_id in self.segments:
+            stats = self.stats[segment_id]
+            cols = {
+                "id": segment_id,
+                "username": self.username,
+                "network_type": self.network_type,
+                "highest_comfort_level": self.highest_comfort_level,
+                "ls_table": self.ls_table,
+                "ids": self.ids,
+                "nodes_table": self.nodes_table,
+                "has_isochrone": self.has_isochrone[segment_id],
+                "miles": self.miles[segment_id],
+                **{column: stats[column] for column in DEMOGRAPHIC_COLUMNS},
+                "circuit": stats["circuit"],
+                "total_jobs": stats["total_jobs"],
+                "bike_ped_crashes": stats.get("bike_ped_crashes", NO_CRASHES),
+                "essential_services": stats["essential_services"],
+                "rail_stations": stats["rail_stations"],
+            }
+
+            if cols["highest_comfort_level"] is None or cols["highest_comfort_level"] == "":
+                cols["highest_comfort_level"] = 0
+
+            summaries.append(cols)
+
+        apply_summaries(self.db, self.network_type, summaries)
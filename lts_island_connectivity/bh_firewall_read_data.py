@@ -8,10 +8,27 @@ This script won't work outside of the DVRPC firewall;
 for server outside of firewall, a sql dump file will have to 
 be used to populate your db with a copy of what is here.
 
+Layers are imported concurrently, up to IMPORT_WORKERS at a time (see your .env
+file). Each task waits for the tasks it depends on, and a summary of every
+task's status, exit code, row count and duration is printed at the end.
+
+Only layers whose source changed since the last run are reimported, see
+refresh.py. Pass --full-refresh to drop the lts and sidewalk schemas and
+reimport everything.
+
+Run it as a module from the root of the repo, like `make data` does:
+
+    python -m lts_island_connectivity.bh_firewall_read_data
+
 """
 
-import os
-from settings import (
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from lts_island_connectivity.settings import (
     DATABASE_URL,
     HOST,
     PORT,
@@ -23,20 +40,47 @@ from settings import (
     GIS_PASSWORD,
     GIS_DB_NAME,
     GIS_PORT,
+    GIS_DATABASE_URL,
+    IMPORT_WORKERS,
+    SUBDIVIDE_MAX_VERTICES,
+)
+from sqlalchemy import text
+from lts_island_connectivity.overlays import SUBDIVIDED_LAYERS, build_subdivided
+from lts_island_connectivity.pool import PooledDatabase, get_engine
+from lts_island_connectivity.refresh import (
+    derived_signature,
+    needs_refresh,
+    setup_refresh_state,
+    source_signature,
+    store_signature,
 )
-from sqlalchemy import create_engine, text
 
-engine = create_engine(f"{DATABASE_URL}")
+engine = get_engine(DATABASE_URL)
+db = PooledDatabase(DATABASE_URL)
+gis_db = PooledDatabase(GIS_DATABASE_URL)
+
+# run and signature are called with no arguments. a non-zero return or an
+# exception from run is a failure, signature returns the signature of the
+# task's source, see refresh.py.
+ImportTask = namedtuple(
+    "ImportTask", ["name", "run", "depends_on", "signature"], defaults=[None]
+)
+ImportResult = namedtuple(
+    "ImportResult", ["name", "status", "exit_code", "rows", "seconds"]
+)
+SUCCEEDED = ("ok", "unchanged")
 
 
-def create_schemas(engine):
+def create_schemas(engine, full_refresh: bool = False):
     connection = engine.connect()
-    query = """
+    drop_schemas = """
+    DROP SCHEMA if exists sidewalk CASCADE;
+    DROP SCHEMA if exists lts CASCADE;"""
+    query = f"""
     CREATE extension if not exists postgis;
     CREATE extension if not exists pgrouting;
-    DROP SCHEMA if exists sidewalk CASCADE;
+    {drop_schemas if full_refresh else ""}
     CREATE SCHEMA if not exists sidewalk;
-    DROP SCHEMA if exists lts CASCADE;
     CREATE SCHEMA if not exists lts;"""
 
     transaction = connection.begin()
@@ -58,36 +102,127 @@ def import_data(
     """
     imports data by creating copies of all tables.
     necessary to copy because of server location; no fdw.
+
+    returns the exit code of ogr2ogr.
     """
 
     print(f"initiating import of {full_layer_tablename}, please wait...")
 
-    os.system(
-        f"""ogr2ogr -lco GEOMETRY_NAME=geom -sql "{sql_query}" -explodecollections -f "PostgreSQL" -overwrite PG:"host={HOST} port={PORT} user={UN} dbname={DB_NAME} password={PW}" -t_srs "EPSG:26918" -f "PostgreSQL" PG:"host={GIS_HOST} port={GIS_PORT} dbname={GIS_DB_NAME} user={GIS_USER} password={GIS_PASSWORD}" -nln {full_layer_tablename}"""
+    # views built on the old table (network nodes) are rebuilt by network_islands.py
+    with engine.begin() as connection:
+        connection.execute(text(f"drop table if exists {full_layer_tablename} CASCADE"))
+
+    completed = subprocess.run(
+        [
+            "ogr2ogr",
+            "-lco",
+            "GEOMETRY_NAME=geom",
+            "-sql",
+            sql_query,
+            "-explodecollections",
+            "-f",
+            "PostgreSQL",
+            "-overwrite",
+            f"PG:host={HOST} port={PORT} user={UN} dbname={DB_NAME} password={PW}",
+            "-t_srs",
+            "EPSG:26918",
+            f"PG:host={GIS_HOST} port={GIS_PORT} dbname={GIS_DB_NAME} user={GIS_USER} password={GIS_PASSWORD}",
+            "-nln",
+            full_layer_tablename,
+        ]
+    )
+    return completed.returncode
+
+
+def import_task(sql_query: str, full_layer_tablename: str, checksum: bool = True):
+    """An ImportTask for a layer, signed by its source query"""
+    return ImportTask(
+        full_layer_tablename,
+        partial(import_data, sql_query, full_layer_tablename),
+        [],
+        partial(source_signature, gis_db, sql_query, checksum),
     )
 
 
-def make_low_stress_lts(lts_level: int = 3):
-    """Make a low stress network based on a certain threshold. Returns LTS network with
-    all segments below specified lts_level (i.e. if write 'lts_level=3', it will create select LTS 1 and 2 as a new table.)
+def count_rows(tablename: str):
+    with engine.connect() as connection:
+        return connection.execute(text(f"select count(*) from {tablename}")).scalar()
+
+
+def run_imports(
+    tasks: list, max_workers: int = IMPORT_WORKERS, full_refresh: bool = False
+):
     """
-    connection = engine.connect()
-    transaction = connection.begin()
-    query = f"""
-        drop table if exists lts.lts_stress_below_{lts_level};
-        create table lts.lts_stress_below_{lts_level} as(
-        select * from lts.lts_full where lts_score::int < {lts_level});
-        """
+    Runs import tasks on a thread pool, max_workers at a time. A task starts once
+    every task it depends on has succeeded, and is skipped if one of them failed.
+    Tasks whose signature matches the one stored at their last import are left
+    alone unless full_refresh is set.
 
-    try:
-        print(f"creating low stress bike network for lts_{lts_level}...")
-        connection.execute(text(query))
-        transaction.commit()
-    except:
-        transaction.rollback()
-        raise
-    finally:
-        connection.close()
+    :returns: an ImportResult per task, in the order the tasks were given
+    """
+    results = {}
+    waiting = list(tasks)
+    running = {}
+
+    def run_task(task):
+        start = time.perf_counter()
+        signature = None
+        try:
+            signature = task.signature() if task.signature else None
+            if not needs_refresh(db, task.name, signature, full_refresh):
+                print(f"{task.name} is unchanged, skipping import..")
+                return ImportResult(
+                    task.name,
+                    "unchanged",
+                    None,
+                    count_rows(task.name),
+                    round(time.perf_counter() - start, 1),
+                )
+            exit_code = task.run() or 0
+        except Exception as e:
+            print(f"{task.name} failed: {e}")
+            exit_code = -1
+        rows = count_rows(task.name) if exit_code == 0 else None
+        status = "ok" if exit_code == 0 else "failed"
+        if exit_code == 0 and signature is not None:
+            store_signature(db, task.name, signature)
+        return ImportResult(
+            task.name, status, exit_code, rows, round(time.perf_counter() - start, 1)
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for task in list(waiting):
+                dependencies = [results.get(name) for name in task.depends_on]
+                if any(
+                    result and result.status not in SUCCEEDED for result in dependencies
+                ):
+                    results[task.name] = ImportResult(
+                        task.name, "skipped", None, None, 0
+                    )
+                    waiting.remove(task)
+                elif all(dependencies):
+                    running[executor.submit(run_task, task)] = task
+                    waiting.remove(task)
+            if not running:
+                # whatever is left depends on a task that doesn't exist
+                for task in waiting:
+                    results[task.name] = ImportResult(
+                        task.name, "skipped", None, None, 0
+                    )
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results[result.name] = result
+                del running[future]
+
+    ordered = [results[task.name] for task in tasks]
+    for result in ordered:
+        print(
+            f"{result.name:<35} {result.status:<8} exit={result.exit_code} rows={result.rows} {result.seconds}s"
+        )
+    return ordered
 
 
 def setup_user_table():
@@ -113,13 +248,16 @@ def setup_user_table():
 
 
 if __name__ == "__main__":
-    create_schemas(engine)
-    import_data(
-        "select *, id as dvrpc_id, lts as lts_score from transportation.lts_network_v2",
-        "lts.lts_full",
-    )
-    import_data(
-        """
+    full_refresh = "--full-refresh" in sys.argv
+    create_schemas(engine, full_refresh)
+    setup_refresh_state(db)
+    tasks = [
+        import_task(
+            "select *, id as dvrpc_id, lts as lts_score from transportation.lts_network_v2",
+            "lts.lts_full",
+        ),
+        import_task(
+            """
         select
           a.d_cntest as disabled,
           a.d_cntmoe as disabled_moe,
@@ -144,38 +282,38 @@ if __name__ == "__main__":
           a.shape
         from demographics.ipd_2021 a
         """,
-        "censustract2020_demographics",
-    )
-    import_data(
-        "select * from transportation.pedestriannetwork_lines where feat_type != 'UNMARKED'",
-        "sidewalk.ped_network",
-    )
-    import_data(
-        "select * from transportation.pedestriannetwork_gaps",
-        "sidewalk.ped_network_gaps",
-    )
-    import_data(
-        "select * from boundaries.municipalboundaries",
-        "municipalboundaries",
-    )
-    import_data(
-        "select * from planning.eta_essentialservicespts",
-        "essential_services",
-    )
-    import_data(
-        "select * from transportation.circuittrails",
-        "circuittrails",
-    )
-    import_data(
-        "select * from transportation.passengerrailstations",
-        "passengerrailstations",
-    )
-    import_data(
-        "select * from planning.dvrpc_landuse_2015",
-        "landuse_2015",
-    )
-    import_data(
-        """
+            "censustract2020_demographics",
+        ),
+        import_task(
+            "select * from transportation.pedestriannetwork_lines where feat_type != 'UNMARKED'",
+            "sidewalk.ped_network",
+        ),
+        import_task(
+            "select * from transportation.pedestriannetwork_gaps",
+            "sidewalk.ped_network_gaps",
+        ),
+        import_task(
+            "select * from boundaries.municipalboundaries",
+            "municipalboundaries",
+        ),
+        import_task(
+            "select * from planning.eta_essentialservicespts",
+            "essential_services",
+        ),
+        import_task(
+            "select * from transportation.circuittrails",
+            "circuittrails",
+        ),
+        import_task(
+            "select * from transportation.passengerrailstations",
+            "passengerrailstations",
+        ),
+        import_task(
+            "select * from planning.dvrpc_landuse_2015",
+            "landuse_2015",
+        ),
+        import_task(
+            """
         select sum(a.c000) as total_jobs, c.shape from economy.lodes_combined_wac a 
         inner join economy.lodes_xwalk b 
         on a.w_geocode = b.tabblk2020 
@@ -187,8 +325,23 @@ if __name__ == "__main__":
         group by c.shape
 
         """,
-        "lodes_2020",
-    )
-    make_low_stress_lts(4)
-    make_low_stress_lts(3)
-    make_low_stress_lts(2)
+            "lodes_2020",
+        ),
+        *[
+            ImportTask(
+                f"{table}_subdivided",
+                partial(build_subdivided, db, table, SUBDIVIDE_MAX_VERTICES),
+                [table],
+                partial(
+                    derived_signature,
+                    db,
+                    [table],
+                    {"max_vertices": SUBDIVIDE_MAX_VERTICES},
+                ),
+            )
+            for table in SUBDIVIDED_LAYERS
+        ],
+    ]
+    results = run_imports(tasks, full_refresh=full_refresh)
+    if any(result.status not in SUCCEEDED for result in results):
+        raise SystemExit(1)
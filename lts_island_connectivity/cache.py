@@ -0,0 +1,105 @@
+"""
+cache.py
+------------------
+Geometry-keyed cache of StudySegment results.
+
+Planners often resubmit the same drawn line under a new name, or with
+overwrite=True. Results are keyed by a hash of the normalized geometry plus
+the network type, comfort level, data version and the refresh signatures of the
+tables the results come from (see refresh.cache_version), so an identical
+request can skip the analysis and reuse the stats and polygons of the first
+one, until the data behind them is reimported or rebuilt.
+
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from .settings import DATA_VERSION, RESULT_CACHE_MAX_AGE, RESULT_CACHE_SIZE
+
+_result_cache = None
+
+
+def geometry_key(
+    geometry: dict,
+    network_type: str,
+    highest_comfort_level,
+    data_version: str = DATA_VERSION,
+    signatures: tuple = (),
+):
+    """
+    Returns the cache key for a segment. Coordinates are rounded to 7 decimals
+    (about a centimeter) and a LineString is treated as a single part
+    MultiLineString, so trivially different drawings of the same line share a key.
+    signatures is the cache_version of the segment's input tables.
+    """
+    if geometry.get("type") == "LineString":
+        lines = [geometry.get("coordinates", [])]
+    else:
+        lines = geometry.get("coordinates", [])
+    normalized = [
+        [[round(float(x), 7), round(float(y), 7)] for x, y, *_ in line]
+        for line in lines
+    ]
+
+    payload = json.dumps(
+        [normalized, network_type, highest_comfort_level, data_version, signatures]
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    In-memory LRU cache of segment results.
+
+    :param int max_size: number of results kept, least recently used are evicted first
+    :param int max_age: seconds a result is kept, None keeps them until evicted
+    """
+
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE, max_age: int = None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None and self.max_age is not None:
+            if time.monotonic() - entry[0] > self.max_age:
+                del self._entries[key]
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def get_result_cache():
+    """Returns the process-wide ResultCache, sized from your .env file"""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_MAX_AGE)
+    return _result_cache
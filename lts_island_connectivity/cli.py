@@ -7,8 +7,12 @@ want to use it over the fastapi/react app.
 """
 
 import click
-import geojson
 from .connections import StudySegment
+from .batch import BatchStudySegments
+from .cache import get_result_cache
+from .instrumentation import Instrumentation
+from .parallel import run_parallel
+from .streaming import iter_features
 
 
 @click.group()
@@ -26,7 +30,7 @@ def main():
 @click.option(
     "--geojson_path",
     required=True,
-    help="path to geojson of feature(s), handles feature and feature collection",
+    help="path to geojson of feature(s), handles feature, feature collection and newline-delimited geojson",
 )
 @click.option("--username", default="cli_user", help="username for db purposes")
 @click.option(
@@ -39,6 +43,37 @@ def main():
     "--pg_config_filepath",
     help="filepath for pg_config if other than default",
 )
+@click.option(
+    "--batch",
+    is_flag=True,
+    help="score every feature of a feature collection in one set-based pass",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="number of worker processes, each with its own db connection",
+)
+@click.option(
+    "--routing_engine",
+    default="pgrouting",
+    type=click.Choice(["pgrouting", "python"]),
+    help="isochrone routing: pgr_drivingDistance or the in-memory python graph",
+)
+@click.option(
+    "--cache",
+    is_flag=True,
+    help="reuse results of identical geometries within this run",
+)
+@click.option(
+    "--metrics",
+    is_flag=True,
+    help="print per-stage timings as json, and store them on user_segments",
+)
+@click.option(
+    "--explain",
+    is_flag=True,
+    help="with --metrics, capture EXPLAIN (ANALYZE, BUFFERS) plans of every query",
+)
 def cx(
     network_type,
     geojson_path,
@@ -46,19 +81,51 @@ def cx(
     highest_comfort_level,
     overwrite,
     pg_config_filepath,
+    batch,
+    workers,
+    routing_engine,
+    cache,
+    metrics,
+    explain,
 ):
     """
-    Runs the LTS / sidewalk analysis on the defined network
+    Runs the LTS / sidewalk analysis on the defined network.
+    Point to a geojson or newline-delimited geojson path on your machine, features
+    are streamed from the file as they are processed.
     """
-    geojson = open_geojson(geojson_path)
+    if batch and workers > 1:
+        raise click.UsageError("--batch and --workers can't be used together")
 
-    """
-    Runs the connections.py file, point to a geojson path on your machine.
-    """
-    geojson = open_geojson(geojson_path)
+    features = iter_features(geojson_path)
 
-    if geojson.features:
-        for feature in geojson.features:
+    if batch:
+        BatchStudySegments(
+            network_type,
+            features,
+            username,
+            highest_comfort_level,
+            overwrite,
+            pg_config_filepath,
+            routing_engine=routing_engine,
+        )
+    elif workers > 1:
+        run_parallel(
+            network_type,
+            features,
+            username,
+            highest_comfort_level,
+            overwrite,
+            pg_config_filepath,
+            workers,
+            routing_engine,
+        )
+    else:
+        result_cache = get_result_cache() if cache else None
+        processed = 0
+        for feature in features:
+            instrumentation = (
+                Instrumentation(explain=explain, store=True) if metrics else None
+            )
             StudySegment(
                 network_type,
                 feature,
@@ -66,25 +133,17 @@ def cx(
                 highest_comfort_level,
                 overwrite,
                 pg_config_filepath,
+                routing_engine=routing_engine,
+                cache=result_cache,
+                instrumentation=instrumentation,
             )
-    elif geojson.feature:
-        StudySegment(
-            network_type,
-            geojson.feature,
-            username,
-            highest_comfort_level,
-            overwrite,
-            pg_config_filepath,
-        )
-    else:
-        print("not sure how to treat this!")
-
-
-def open_geojson(path: str):
-    with open(path) as f:
-        s = f.read()
-        gj = geojson.loads(s)
-        return gj
+            processed += 1
+            if instrumentation is not None:
+                click.echo(instrumentation.to_json())
+        if result_cache is not None:
+            print(f"result cache: {result_cache.stats()}")
+        if not processed:
+            print("not sure how to treat this!")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,95 @@
-from pg_data_etl import Database
 import json
 from geoalchemy2 import WKTElement
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
 import re
 import requests
 from pathlib import Path
-from psycopg2 import OperationalError
+from sqlalchemy.exc import OperationalError
+from contextlib import nullcontext
+from .cache import ResultCache, geometry_key
+from .crashes import NO_CRASHES, get_crash_client
+from .instrumentation import Instrumentation, InstrumentedDatabase
+from .islands import METERS_PER_MILE
+from .overlays import intersecting, overlay
+from .pool import get_database
+from .refresh import cache_version
+from .routing import TOPOLOGY_TABLES, isochrone_radius, reachable_nodes
+from .schema import ensure_schema
+from .settings import PULL_CRASHES
+from .statements import prepared
+
+
+DEMOGRAPHIC_COLUMNS = [
+    "total_pop",
+    "disabled",
+    "ethnic_minority",
+    "female",
+    "foreign_born",
+    "lep",
+    "low_income",
+    "older_adult",
+    "racial_minority",
+    "youth",
+]
+
+
+# json columns of user_segments
+JSON_COLUMNS = {"circuit", "bike_ped_crashes", "essential_services", "rail_stations"}
+
+# attributes of a StudySegment kept in the result cache
+CACHED_ATTRIBUTES = [
+    "has_isochrone",
+    "island_miles",
+    "miles",
+    *DEMOGRAPHIC_COLUMNS,
+    "circuit",
+    "jobs",
+    "bike_ped_crashes",
+    "essential_services",
+    "rail_stations",
+]
+
+# tables holding a segment's polygons, keyed by the segment id
+RESULT_TABLES = ["user_buffers", "user_islands", "user_blobs", "user_isochrones"]
+
+# reads of a segment's stats once its blob or isochrone exists, independent of
+# each other: (attribute, column(s), table, geom_type). "polygons" pulls several
+# columns in one overlay, see pull_stats
+SEGMENT_STATS = [
+    ("demographics", DEMOGRAPHIC_COLUMNS, "censustract2020_demographics", "polygons"),
+    ("circuit", "circuit", "circuittrails", "line"),
+    ("jobs", "total_jobs", "lodes_2020", "polygon"),
+    ("essential_services", "type", "essential_services", "point"),
+    ("rail_stations", "type", "passengerrailstations", "point"),
+]
+
+# stages of the analysis that build a segment's study area, in the order they
+# run, each with the stages it depends on
+STUDY_AREA_STAGES = {
+    "buffer_study_segment": [],
+    "generate_proximate_islands": ["buffer_study_segment"],
+    "generate_mileage": ["generate_proximate_islands"],
+    "decide_scope": ["generate_mileage"],
+    "generate_proximate_blobs": ["decide_scope"],
+    "handle_parking_lots": ["generate_proximate_blobs"],
+    "update_mileage": ["decide_scope"],
+}
+
+# a stage per read of SEGMENT_STATS, once the study area is finished
+STAT_STAGES = {
+    f"pull_stats:{table}" if geom_type == "polygons" else f"pull_stat:{table}": (
+        attribute,
+        column,
+        table,
+        geom_type,
+    )
+    for attribute, column, table, geom_type in SEGMENT_STATS
+}
+
+STAGES = {
+    **STUDY_AREA_STAGES,
+    **{stage: ["handle_parking_lots"] for stage in STAT_STAGES},
+    "pull_crashes": ["buffer_study_segment"],
+}
 
 
 class SegmentNameConflictError(Exception):
@@ -15,7 +98,245 @@ class SegmentNameConflictError(Exception):
     pass
 
 
+def network_tables(network_type: str, highest_comfort_level: int = 2):
+    """
+    Returns the comfort level, low stress table, id column and nodes table used
+    for a network type.
+    """
+    if network_type == "lts":
+        ls_table = f"lts_stress_below_{highest_comfort_level + 1}"
+        ids = "dvrpc_id"
+        nodes_table = f"{network_type}{highest_comfort_level + 1}nodes"
+    elif network_type == "sidewalk":
+        highest_comfort_level = ""
+        ls_table = "ped_network"
+        ids = "objectid"
+        nodes_table = f"{network_type}nodes"
+    else:
+        raise ValueError("Network type is unexpected, should be sidewalk or lts")
+    return [highest_comfort_level, ls_table, ids, nodes_table]
+
+
+def result_inputs(network_type: str, highest_comfort_level: int = 2):
+    """
+    Returns the tables a segment's results are computed from, whose refresh
+    signatures key the result cache
+    """
+    hcl, ls_table, _, nodes_table = network_tables(network_type, highest_comfort_level)
+    islands = f"{network_type}.{network_type}{hcl}_islands"
+    overlays = [table for _, _, table, _ in SEGMENT_STATS] + ["landuse_2015"]
+    return [
+        f"{network_type}.{ls_table}",
+        f"{network_type}.{nodes_table}",
+        TOPOLOGY_TABLES[network_type],
+        islands,
+        f"{islands}_buffers",
+        f"{islands}_stats",
+        *overlays,
+        *(f"{table}_subdivided" for table in overlays),
+    ]
+
+
+def geometry_to_wkt(geometry: dict):
+    """Converts a geojson LineString or MultiLineString geometry to WKT"""
+
+    if geometry.get("type") == "LineString":
+        coordinates = geometry.get("coordinates", [])
+        coord_str = ", ".join([f"{x} {y}" for x, y in coordinates])
+        line_wkt = f"LINESTRING({coord_str})"
+    elif geometry.get("type") == "MultiLineString":
+        multi_coordinates = geometry.get("coordinates", [])
+        lines = []
+        for line in multi_coordinates:
+            coord_str = ", ".join([f"{x} {y}" for x, y in line])
+            lines.append(f"({coord_str})")
+        line_wkt = f"MULTILINESTRING({', '.join(lines)})"
+
+    else:
+        raise ValueError("Geojson must be of type LineString or MultiLineString")
+
+    return line_wkt
+
+
+def study_area(schema: str, has_isochrone: bool, table: str = ""):
+    """
+    The table holding a segment's study area: its isochrone or blob, or just its
+    buffer for crashes, which are only reported on the segment itself.
+
+    :param str schema: schema of the segment's result tables, the network type
+        or pg_temp for transient segments
+    """
+    if table.endswith("crashes"):
+        return f"{schema}.user_buffers"
+    if has_isochrone is True:
+        return f"{schema}.user_isochrones"
+    elif has_isochrone is False:
+        return f"{schema}.user_blobs"
+
+
+def stat_query(db, column: str, table: str, geom_type: str, polygon: str):
+    """SQL of pull_stat over the study area in polygon with id :id"""
+    geom_type = geom_type.lower()
+
+    if geom_type == "polygon":
+        return f"""
+                with total as(
+                    select round(a.ratio * a.{column}) as {column}_in_blobs
+                    from {overlay(db, table, [column], polygon, "b.id = :id")} a
+                    where a.{column} >= 0)
+                select round(sum({column}_in_blobs)) from total
+        """
+
+    if geom_type == "point":
+        return f"""select count(a.{column}), a.{column} from {table} a, {polygon} b
+                    where st_intersects(a.geom, b.geom)
+                    and (b.id = :id)
+                    group by a.{column}"""
+
+    if geom_type == "line":
+        return f"""
+                select
+                    {column},
+                    sum(miles) as miles
+                from (
+                    select
+                        a.{column},
+                        st_length(a.geom)/{METERS_PER_MILE} as miles
+                    from
+                        {table} a,
+                        {polygon} b
+                    where
+                        st_intersects(a.geom, b.geom)
+                        and (b.id = :id)
+                ) as subquery
+                group by
+                    {column}
+                    """
+
+
+def stats_query(db, columns: list, table: str, polygon: str):
+    """SQL of pull_stats over the study area in polygon with id :id"""
+    apportioned = ", ".join(
+        f"round(sum(case when {column} >= 0 then round(ratio * {column}) end))"
+        for column in columns
+    )
+    return f"""
+            with total as(
+                select * from {overlay(db, table, columns, polygon, "b.id = :id")} a)
+            select {apportioned} from total
+        """
+
+
+def rounded(value):
+    """Polygon stats are reported to the nearest hundred"""
+    return None if value is None else int(round(value, -2))
+
+
+def summary_update(network_type: str, columns: list):
+    """
+    Returns a single bound-parameter update of the given user_segments columns,
+    keyed by :id and :username. json columns are cast from their serialized text.
+    """
+    assignments = ",\n            ".join(
+        f"{column} = CAST(:{column} AS json)"
+        if column in JSON_COLUMNS
+        else f"{column} = :{column}"
+        for column in columns
+    )
+    return f"""
+        update {network_type}.user_segments
+        set {assignments}
+        where id = :id
+        and username = :username
+    """
+
+
+def apply_summaries(db, network_type: str, summaries: list):
+    """
+    Writes the summary columns of one or many segments in one statement, executed
+    for every segment in a single transaction.
+
+    :param list summaries: dicts with the segment's id, username and a value for
+        each column to update. every dict must have the same columns.
+    """
+    if not summaries:
+        return
+    columns = [key for key in summaries[0] if key not in ("id", "username")]
+    params = [
+        {
+            key: json.dumps(value)
+            if key in JSON_COLUMNS and value is not None
+            else value
+            for key, value in summary.items()
+        }
+        for summary in summaries
+    ]
+    db.execute(prepared(summary_update(network_type, columns)), params)
+
+
+class LazyAttribute:
+    """
+    A StudySegment attribute set by a stage of the analysis. Reading it before
+    the stage has run runs the stage, and the stages it depends on, first.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, segment, owner=None):
+        if segment is None:
+            return self
+        if self.name not in segment.__dict__:
+            segment.compute(self.stage)
+        try:
+            return segment.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, segment, value):
+        segment.__dict__[self.name] = value
+
+
 class StudySegment:
+    """
+    Scores a study segment: builds its study area (the islands it touches, and
+    their blob or isochrone), pulls the stats inside it and writes them to its
+    user_segments row.
+
+    With transient=True the whole analysis runs in one transaction on one pooled
+    connection, with buffers, islands, blobs and isochrones in session temp
+    tables. Only the segment's row and its blob or isochrone are written to the
+    permanent tables, when the transaction commits, and nothing is if any
+    statement fails.
+
+    With lazy=True only the segment row is created, and each stage runs when an
+    attribute that needs it is first read, so reading island_miles only buffers
+    the segment and finds its islands. Summary columns are then only written by
+    calling summarize_stats, which pulls every stat.
+    """
+
+    island_miles = LazyAttribute("generate_mileage")
+    has_isochrone = LazyAttribute("decide_scope")
+    miles = LazyAttribute("update_mileage")
+    total_pop = LazyAttribute("pull_stats:censustract2020_demographics")
+    disabled = LazyAttribute("pull_stats:censustract2020_demographics")
+    ethnic_minority = LazyAttribute("pull_stats:censustract2020_demographics")
+    female = LazyAttribute("pull_stats:censustract2020_demographics")
+    foreign_born = LazyAttribute("pull_stats:censustract2020_demographics")
+    lep = LazyAttribute("pull_stats:censustract2020_demographics")
+    low_income = LazyAttribute("pull_stats:censustract2020_demographics")
+    older_adult = LazyAttribute("pull_stats:censustract2020_demographics")
+    racial_minority = LazyAttribute("pull_stats:censustract2020_demographics")
+    youth = LazyAttribute("pull_stats:censustract2020_demographics")
+    circuit = LazyAttribute("pull_stat:circuittrails")
+    jobs = LazyAttribute("pull_stat:lodes_2020")
+    essential_services = LazyAttribute("pull_stat:essential_services")
+    rail_stations = LazyAttribute("pull_stat:passengerrailstations")
+    bike_ped_crashes = LazyAttribute("pull_crashes")
+
     def __init__(
         self,
         network_type: str,
@@ -24,12 +345,23 @@ class StudySegment:
         highest_comfort_level: int = 2,
         overwrite: bool = False,
         pg_config_filepath: str = None,
-        override_isochrone_flag: bool = True
+        override_isochrone_flag: bool = True,
+        routing_engine: str = "pgrouting",
+        cache: ResultCache = None,
+        instrumentation: Instrumentation = None,
+        defer_stats: bool = False,
+        lazy: bool = False,
+        transient: bool = False,
     ) -> None:
-        self.db = Database.from_config("localhost", pg_config_filepath)
+        if transient and (lazy or defer_stats):
+            raise ValueError("transient segments can't be lazy or defer their stats")
+        pooled = get_database("localhost", pg_config_filepath)
+        self.instrumentation = instrumentation
+        self.db = self.__instrumented(pooled)
         self.network_type = network_type
         self.highest_comfort_level = highest_comfort_level
         self.override_isochrone_flag = override_isochrone_flag
+        self.routing_engine = routing_engine
         segment_tablenames = self.__update_highest_comfort_level()
         self.highest_comfort_level = segment_tablenames[0]
         self.ls_table = segment_tablenames[1]
@@ -40,102 +372,148 @@ class StudySegment:
         self.properties = feature["properties"]
         self.segment_name = self.__sanitize_name()
         self.username = username
-        self.__setup_study_segment_tables()
-        self.study_segment_id = self.__create_study_segment(
-            self.geometry, self.username, self.network_type, overwrite
-        )
-        self.__buffer_study_segment()
-        self.__generate_proximate_islands()
-        self.has_isochrone = None
-        self.miles = self.__generate_mileage()
-        self.has_isochrone = self.__decide_scope()
-        
-        self.__generate_proximate_blobs()
-        self.__handle_parking_lots()
-        self.__update_mileage()
-
-        self.total_pop = self.pull_stat(
-            self.study_segment_id,
-            "total_pop",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.disabled = self.pull_stat(
-            self.study_segment_id,
-            "disabled",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.ethnic_minority = self.pull_stat(
-            self.study_segment_id,
-            "ethnic_minority",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.female = self.pull_stat(
-            self.study_segment_id,
-            "female",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.foreign_born = self.pull_stat(
-            self.study_segment_id,
-            "foreign_born",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.lep = self.pull_stat(
-            self.study_segment_id,
-            "lep",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.low_income = self.pull_stat(
-            self.study_segment_id,
-            "low_income",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.older_adult = self.pull_stat(
-            self.study_segment_id,
-            "older_adult",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.racial_minority = self.pull_stat(
-            self.study_segment_id,
-            "racial_minority",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.youth = self.pull_stat(
-            self.study_segment_id,
-            "youth",
-            "censustract2020_demographics",
-            "polygon",
-        )
-        self.circuit = self.pull_stat(
-            self.study_segment_id, "circuit", "circuittrails", "line"
-        )
-        self.jobs = self.pull_stat(
-            self.study_segment_id, "total_jobs", "lodes_2020", "polygon"
-        )
-        # self.bike_ped_crashes = self.pull_crashes(
-        #     self.study_segment_id,
-        # )
-        self.essential_services = self.pull_stat(
-            self.study_segment_id,
-            "type",
-            "essential_services",
-            "point",
-        )
-        self.rail_stations = self.pull_stat(
-            self.study_segment_id,
-            "type",
-            "passengerrailstations",
-            "point",
-        )
-        self.summarize_stats()
+        self.lazy = lazy
+        self.transient = transient
+        self.results_schema = "pg_temp" if transient else network_type
+        self.__completed = set()
+        if not PULL_CRASHES:
+            self.bike_ped_crashes = dict(NO_CRASHES)
+        with self.__stage("setup_tables"):
+            self.__setup_study_segment_tables()
+
+        if transient:
+            with pooled.transaction() as db:
+                self.db = self.__instrumented(db)
+                self.__create_transient_tables()
+                self.__score(overwrite, cache, defer_stats)
+                with self.__stage("persist_study_area"):
+                    self.__persist_study_area()
+            self.db = self.__instrumented(pooled)
+        else:
+            self.__score(overwrite, cache, defer_stats)
+
+    def __instrumented(self, db):
+        if self.instrumentation is None:
+            return db
+        return InstrumentedDatabase(db, self.instrumentation)
+
+    def __score(self, overwrite: bool, cache: ResultCache, defer_stats: bool):
+        """Creates the segment's row, then restores or analyzes its results"""
+        with self.__stage("create_study_segment"):
+            self.study_segment_id = self.__create_study_segment(
+                self.geometry, self.username, self.network_type, overwrite
+            )
+        self.cache = cache
+        cached = None
+        if self.cache is not None:
+            self.cache_key = geometry_key(
+                self.geometry,
+                self.network_type,
+                self.highest_comfort_level,
+                signatures=cache_version(
+                    self.db, result_inputs(self.network_type, self.highest_comfort_level)
+                ),
+            )
+            cached = self.cache.get(self.cache_key)
+
+        self.stats_pending = False
+        if cached is not None:
+            print("identical segment found in cache, reusing its results..")
+            with self.__stage("restore_cached_results"):
+                self.__restore_cached_results(cached)
+            self.__completed.update(STAGES)
+            if not self.lazy:
+                self.__finish()
+        elif not self.lazy:
+            for stage in STUDY_AREA_STAGES:
+                self.compute(stage)
+            self.stats_pending = True
+            if not defer_stats:
+                for stage in STAT_STAGES:
+                    self.compute(stage)
+                if PULL_CRASHES:
+                    self.compute("pull_crashes")
+                self.__complete()
+
+    def __stage(self, name: str):
+        """Times a stage when instrumentation is on"""
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.stage(name)
+
+    def __finish(self):
+        with self.__stage("summarize_stats"):
+            self.summarize_stats()
+        if self.instrumentation is not None and self.instrumentation.store:
+            self.__store_metrics()
+
+    def __complete(self):
+        self.stats_pending = False
+        if self.cache is not None:
+            self.cache.put(self.cache_key, self.__snapshot_results())
+        self.__finish()
+
+    def complete_stats(self, stats: dict):
+        """
+        Sets the stats of the segment, keyed by the attributes of SEGMENT_STATS,
+        caches its results and writes its summary columns. With defer_stats the
+        segment stops once its study area exists, and whoever pulls its stats
+        (see AsyncStudySegment) calls this.
+        """
+        for stage, (attribute, *_) in STAT_STAGES.items():
+            self.__set_stat(attribute, stats[attribute])
+            self.__completed.add(stage)
+        if "bike_ped_crashes" in stats:
+            self.bike_ped_crashes = stats["bike_ped_crashes"]
+            self.__completed.add("pull_crashes")
+        self.__complete()
+
+    def __set_stat(self, attribute: str, value):
+        if attribute == "demographics":
+            for column in DEMOGRAPHIC_COLUMNS:
+                setattr(self, column, value[column])
+        else:
+            setattr(self, attribute, value)
+
+    def compute(self, stage: str):
+        """
+        Runs a stage of the analysis (see STAGES), after the stages it depends
+        on, unless it has already run.
+        """
+        if stage in self.__completed:
+            return
+        for dependency in STAGES[stage]:
+            self.compute(dependency)
+        with self.__stage(stage):
+            self.__run(stage)
+        self.__completed.add(stage)
+
+    def __run(self, stage: str):
+        if stage == "buffer_study_segment":
+            self.__buffer_study_segment()
+        elif stage == "generate_proximate_islands":
+            self.__generate_proximate_islands()
+        elif stage == "generate_mileage":
+            self.island_miles = self.__generate_mileage()
+        elif stage == "decide_scope":
+            self.has_isochrone = self.__decide_scope()
+        elif stage == "generate_proximate_blobs":
+            self.__generate_proximate_blobs()
+        elif stage == "handle_parking_lots":
+            self.__handle_parking_lots()
+        elif stage == "update_mileage":
+            self.__update_mileage()
+        elif stage == "pull_crashes":
+            self.bike_ped_crashes = self.pull_crashes(self.study_segment_id)[0]
+        else:
+            attribute, column, table, geom_type = STAT_STAGES[stage]
+            if geom_type == "polygons":
+                value = self.pull_stats(self.study_segment_id, column, table)
+            else:
+                value = self.pull_stat(
+                    self.study_segment_id, column, table, geom_type
+                )
+            self.__set_stat(attribute, value)
 
     def __get_name(self):
         return self.properties.get("name") or self.properties.get("Name")
@@ -146,78 +524,49 @@ class StudySegment:
         return re.sub(r"[^a-zA-Z0-9 ]", "", segment_name)
 
     def __update_highest_comfort_level(self):
-        if self.network_type == "lts":
-            self.highest_comfort_level = self.highest_comfort_level
-            self.ls_table = f"lts_stress_below_{self.highest_comfort_level + 1}"
-            self.ids = "dvrpc_id"
-            self.nodes_table = (
-                f"{self.network_type}{self.highest_comfort_level + 1}nodes"
-            )
-        elif self.network_type == "sidewalk":
-            self.highest_comfort_level = ""
-            self.ls_table = "ped_network"
-            self.ids = "objectid"
-            self.nodes_table = f"{self.network_type}nodes"
-        else:
-            raise ValueError("Network type is unexpected, should be sidewalk or lts")
-        return [self.highest_comfort_level, self.ls_table, self.ids, self.nodes_table]
+        return network_tables(self.network_type, self.highest_comfort_level)
 
     def __setup_study_segment_tables(self):
-        for value in [
-            "user_segments",
-            "user_buffers",
-            "user_islands",
-            "user_blobs",
-            "user_isochrones",
-        ]:
-            if value == "user_segments":
-                query = f"""
-                    CREATE TABLE IF NOT EXISTS {self.network_type}.{value}(
-                        id SERIAL PRIMARY KEY,
-                        username VARCHAR,
-                        seg_name VARCHAR,
-                        network_type VARCHAR,
-                        highest_comfort_level INT,
-                        ls_table VARCHAR,
-                        ids VARCHAR,
-                        nodes_table VARCHAR,
-                        has_isochrone BOOL,
-                        miles REAL,
-                        total_pop INT,
-                        disabled INT,
-                        ethnic_minority INT,
-                        female INT,
-                        foreign_born INT,
-                        lep INT,
-                        low_income INT,
-                        older_adult INT,
-                        racial_minority INT,
-                        youth INT,
-                        circuit JSON,
-                        total_jobs INT,
-                        bike_ped_crashes JSON,
-                        essential_services JSON,
-                        rail_stations JSON,
-                        deleted BOOL,
-                        shared BOOL,
-                        geom GEOMETRY
-                    );
-                """
-            else:
-                query = f"""
-                    CREATE TABLE IF NOT EXISTS {self.network_type}.{value}(
-                        id SERIAL PRIMARY KEY,
-                        username VARCHAR,
-                        geom GEOMETRY
-                    );
-                """
-            self.db.execute(query)
+        ensure_schema(self.db, self.network_type)
+
+    def __create_transient_tables(self):
+        """
+        Creates session temp copies of the result tables, with the columns and
+        indexes of the permanent ones, dropped when the transaction ends.
+        """
+        self.db.execute(
+            "\n".join(
+                f"""create temporary table {table}
+                (like {self.network_type}.{table} including all) on commit drop;"""
+                for table in RESULT_TABLES
+            )
+        )
+
+    def __persist_study_area(self):
+        """
+        Copies the segment's isochrone or blob, the polygon its stats come from,
+        from its temp table to the permanent one. Buffers and islands aren't kept.
+        """
+        table = "user_isochrones" if self.has_isochrone else "user_blobs"
+        self.db.execute(
+            prepared(
+                f"""
+            insert into {self.network_type}.{table}
+            select * from pg_temp.{table}
+            where id = :id
+            """
+            ),
+            {"id": self.study_segment_id},
+        )
 
     def __check_segname(self):
         """Checks to see if segment is already in DB"""
 
         segs = self.db.query(
-            f"select seg_name from {self.network_type}.user_segments where username = '{self.username}'"
+            prepared(
+                f"select seg_name from {self.network_type}.user_segments where username = :username"
+            ),
+            {"username": self.username},
         )
 
         # flattens list returned from db.query
@@ -235,10 +584,6 @@ class StudySegment:
         """
         Creates a study segment / study segments based on user's drawn geometry.
         """
-        engine = create_engine(self.db.uri)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-
         segment_name = self.segment_name
 
         db_segments = self.__check_segname()
@@ -247,31 +592,17 @@ class StudySegment:
             raise SegmentNameConflictError("Project name already used.")
 
         if overwrite:
-            delete_query = text(
-                f"""
+            self.db.execute(
+                prepared(
+                    f"""
                 DELETE FROM {network_type}.user_segments
                 WHERE seg_name = :seg_name AND username = :username
             """
+                ),
+                {"seg_name": segment_name, "username": username},
             )
-            session.execute(
-                delete_query, params={"seg_name": segment_name, "username": username}
-            )
-            session.commit()
-
-        if self.geometry.get("type") == "LineString":
-            coordinates = self.geometry.get("coordinates", [])
-            coord_str = ", ".join([f"{x} {y}" for x, y in coordinates])
-            line_wkt = f"LINESTRING({coord_str})"
-        elif self.geometry.get("type") == "MultiLineString":
-            multi_coordinates = self.geometry.get("coordinates", [])
-            lines = []
-            for line in multi_coordinates:
-                coord_str = ", ".join([f"{x} {y}" for x, y in line])
-                lines.append(f"({coord_str})")
-            line_wkt = f"MULTILINESTRING({', '.join(lines)})"
 
-        else:
-            raise ValueError("Geojson must be of type LineString or MultiLineString")
+        line_wkt = geometry_to_wkt(self.geometry)
 
         wkt_element = WKTElement(line_wkt, srid=4326)
         table_name = f"{network_type}.user_segments"
@@ -279,26 +610,17 @@ class StudySegment:
         INSERT INTO {table_name}
         (id, username, seg_name, geom)
         VALUES (DEFAULT, :username, :seg_name, ST_Transform(ST_GeomFromText(:geom, 4326), 26918))
+        RETURNING id
         """
 
-        query = text(query)
-
-        session.execute(
-            query,
-            params={
+        study_segment_id = self.db.query_as_singleton(
+            prepared(query),
+            {
                 "username": username,
                 "seg_name": segment_name,
                 "geom": wkt_element.desc,
             },
         )
-        session.commit()
-
-        study_segment_id = self.db.query_as_singleton(
-            f"""
-            select id from {self.network_type}.user_segments a
-            where a.seg_name = '{self.segment_name}'
-            and a.username = '{self.username}'"""
-        )
 
         return study_segment_id
 
@@ -309,13 +631,15 @@ class StudySegment:
         """
 
         self.db.execute(
-            f"""
-                insert into {self.network_type}.user_buffers
-                select id, username, st_buffer(geom, {distance}) as geom
+            prepared(
+                f"""
+                insert into {self.results_schema}.user_buffers
+                select id, username, st_buffer(geom, :distance) as geom
                 from {self.network_type}.user_segments
-                where seg_name = '{self.segment_name}'
-                and username = '{self.username}'
+                where id = :id
             """
+            ),
+            {"distance": distance, "id": self.study_segment_id},
         )
 
     def __generate_proximate_islands(self):
@@ -328,24 +652,24 @@ class StudySegment:
         print("generating proximate islands, please wait..")
 
         self.db.execute(
-            f"""
-                alter table {self.network_type}.user_islands
-                add column if not exists size_miles float;
-                insert into {self.network_type}.user_islands
+            prepared(
+                f"""
+                insert into {self.results_schema}.user_islands
                     select
                         a.id,
                         a.username,
                         st_collectionextract(st_collect(b.geom)) as geom,
                         sum(b.size_miles)
-                    from {self.network_type}.user_buffers a
+                    from {self.results_schema}.user_buffers a
                     inner join {self.network_type}.{self.network_type}{self.highest_comfort_level}_islands b
                     on st_intersects(a.geom,b.geom)
                     inner join {self.network_type}.user_segments c
                     on a.id = c.id
-                    where c.seg_name = '{self.segment_name}'
-                    and c.username = '{self.username}'
+                    where c.id = :id
                     group by a.id
             """
+            ),
+            {"id": self.study_segment_id},
         )
 
     def __generate_proximate_blobs(self):
@@ -353,23 +677,32 @@ class StudySegment:
         Creates 'blobs' around each island collection.
         Note that this query also unions the islands with the study segment buffer.
 
+        The 100m buffer of every island is precomputed in {islands}_buffers (see
+        network_islands.py), so this only unions the buffers of the proximate islands.
         """
+        islands = f"{self.network_type}.{self.network_type}{self.highest_comfort_level}_islands"
 
         if self.has_isochrone is True:
             pass
         else:
             self.db.execute(
-                f"""
-                    insert into {self.network_type}.user_blobs
-                    select a.id, a.username, st_union(st_buffer(a.geom, 100), c.geom) as geom
-                    from {self.network_type}.user_islands a
-                    inner join {self.network_type}.user_segments b
-                    on a.id = b.id
-                    inner join {self.network_type}.user_buffers c
-                    on a.id = c.id
-                    where b.seg_name = '{self.segment_name}'
-                    and b.username = '{self.username}'
+                prepared(
+                    f"""
+                    insert into {self.results_schema}.user_blobs
+                    select c.id, c.username, st_union(i.geom, c.geom) as geom
+                    from {self.results_schema}.user_buffers c
+                    cross join lateral (
+                        select st_union(b.geom) as geom
+                        from {islands} a
+                        inner join {islands}_buffers b
+                        on a.uid = b.uid
+                        where st_intersects(c.geom, a.geom)
+                    ) as i
+                    where c.id = :id
+                    and i.geom is not null
                 """
+                ),
+                {"id": self.study_segment_id},
             )
 
     def __handle_parking_lots(self):
@@ -392,23 +725,22 @@ class StudySegment:
         print("folding in proximate parking lots and associated lu's, please wait..")
 
         if self.has_isochrone is True:
-            join_table = f"{self.network_type}.user_isochrones"
+            join_table = f"{self.results_schema}.user_isochrones"
         elif self.has_isochrone is False:
-            join_table = f"{self.network_type}.user_blobs"
+            join_table = f"{self.results_schema}.user_blobs"
         else:
             print("something went wrong with isochrone scope")
 
         self.db.execute(
-            f"""
+            prepared(
+                f"""
             WITH proximate_lu AS (
                 SELECT a.geom, c.id, c.seg_name, a.lu15subn
-                FROM landuse_2015 a
-                INNER JOIN {self.network_type}.user_buffers b
-                ON ST_Intersects(a.geom, b.geom)
+                FROM {self.results_schema}.user_buffers b
                 INNER JOIN {self.network_type}.user_segments c
                 ON b.id = c.id
-                WHERE c.seg_name = '{self.segment_name}'
-                AND c.username = '{self.username}'
+                CROSS JOIN {intersecting(self.db, "landuse_2015", "b.geom")} a
+                WHERE c.id = :id
                 AND (
                     a.lu15subn LIKE 'Parking%'
                     OR a.lu15subn LIKE 'Institutional%'
@@ -420,9 +752,9 @@ class StudySegment:
             proximate_lu_and_touching AS (
                 SELECT st_collect(b.geom, a.geom) as geom
                 FROM proximate_lu a
-                inner JOIN landuse_2015 b
-                ON ST_Touches(a.geom, b.geom)
-                Where (
+                CROSS JOIN {intersecting(self.db, "landuse_2015", "a.geom")} b
+                Where ST_Touches(a.geom, b.geom)
+                AND (
                     b.lu15subn LIKE 'Parking%'
                     OR b.lu15subn LIKE 'Institutional%'
                     OR b.lu15subn LIKE 'Commercial%'
@@ -433,9 +765,11 @@ class StudySegment:
             UPDATE {join_table} AS b
             SET geom = ST_Union(a.geom, b.geom)
             from proximate_lu_and_touching a
-            where b.id = {self.study_segment_id}
+            where b.id = :id
 
         """
+            ),
+            {"id": self.study_segment_id},
         )
 
     def __create_isochrone(self, travel_time: int = 15):
@@ -443,68 +777,145 @@ class StudySegment:
         Creates isochrone based on study_segment
         """
 
+        if self.routing_engine == "python":
+            nodes = """nodes AS (
+                        SELECT unnest(CAST(:nodes AS integer[])) AS node
+                    ),"""
+            params = {
+                "id": self.study_segment_id,
+                "nodes": reachable_nodes(
+                    self.db,
+                    self.network_type,
+                    self.ls_table,
+                    self.nodes_table,
+                    self.study_segment_id,
+                    travel_time,
+                    f"{self.results_schema}.user_buffers",
+                )
+            }
+        else:
+            radius = isochrone_radius(
+                self.db, self.network_type, self.ls_table, travel_time
+            )
+            nodes = f"""nodes AS (
+                        SELECT *
+                        FROM pgr_drivingDistance(
+                            -- only edges within reach of the start nodes, see isochrone_radius
+                            format(
+                                'SELECT {self.ids} as id, source, target, traveltime_min as cost FROM {self.network_type}.{self.ls_table} WHERE geom && %L::geometry', -- example: ls_stress_below_3
+                                (SELECT ST_Expand(ST_Collect(a.geom), {radius}) FROM {self.network_type}.{self.nodes_table} a
+                                 INNER JOIN {self.network_type}.{self.ls_table} b ON a.id = b."source"
+                                 WHERE b.{self.ids}= ANY((SELECT ids FROM arrays)::integer[]))
+                            ),
+                            (SELECT array_agg("source") FROM {self.network_type}.{self.nodes_table} a
+                             INNER JOIN {self.network_type}.{self.ls_table} b ON a.id = b."source"
+                             WHERE b.{self.ids}= ANY((SELECT ids FROM arrays)::integer[])), -- Using ANY with integer array
+                            :travel_time, false
+                        ) AS di
+                        JOIN {self.network_type}.{self.nodes_table} pt ON di.node = pt.id
+                    ),"""
+            params = {"id": self.study_segment_id, "travel_time": travel_time}
+
         try:
             sql = f"""
-                    alter table {self.network_type}.user_isochrones
-                    add column if not exists miles FLOAT;
-                    insert into {self.network_type}.user_isochrones
+                    insert into {self.results_schema}.user_isochrones
                     WITH arrays AS (
                         select a.id as id, --id of user segment, tied to blobs, buffer, etc
                         a.username,
                         a.seg_name,
                         array_agg(c.{self.ids}) as ids --ids in low stress table
                         FROM {self.network_type}.user_segments a
-                        INNER JOIN {self.network_type}.user_buffers b ON a.id = b.id
+                        INNER JOIN {self.results_schema}.user_buffers b ON a.id = b.id
                         INNER JOIN {self.network_type}.{self.ls_table} c ON st_intersects(b.geom, c.geom)
-                        WHERE a.seg_name = '{self.segment_name}'
-                        AND a.username = '{self.username}'
+                        WHERE a.id = :id
                         group by a.id
                     ),
-                    nodes AS (
-                        SELECT *
-                        FROM pgr_drivingDistance(
-                            'SELECT {self.ids} as id, source, target, traveltime_min as cost FROM {self.network_type}.{self.ls_table}', -- example: ls_stress_below_3
-                            (SELECT array_agg("source") FROM {self.network_type}.{self.nodes_table} a
-                             INNER JOIN {self.network_type}.{self.ls_table} b ON a.id = b."source"
-                             WHERE b.{self.ids}= ANY((SELECT ids FROM arrays)::integer[])), -- Using ANY with integer array
-                            {travel_time}, false
-                        ) AS di
-                        JOIN {self.network_type}.{self.nodes_table} pt ON di.node = pt.id
-                    ),
+                    {nodes}
                     node_buffer as (
                         select ST_Union(ST_Buffer(pt.geom, 1000)) AS geom
                         from nodes n
                         join {self.network_type}.{self.nodes_table} pt ON n.node = pt.id
                 )
-                    select (select id from arrays) as id, (select username from arrays), st_union(st_buffer(a.geom, 100)) as geom, round(st_length(st_union(a.geom))/1609) as miles
+                    select (select id from arrays) as id, (select username from arrays), st_union(st_buffer(a.geom, 100)) as geom, round(st_length(st_union(a.geom))/{METERS_PER_MILE}) as miles
                         from {self.network_type}.{self.ls_table} a
                         where st_intersects(a.geom, (select geom from node_buffer))
-                        and (select seg_name from arrays) = '{self.segment_name}';
+                        and (select id from arrays) = :id
 
                     """
-            self.db.execute(sql)
+            # in transient mode a failure would otherwise abort the segment's transaction
+            with self.db.savepoint():
+                self.db.execute(prepared(sql), params)
         except OperationalError:
             print(
                 f"failed to create isochrone for this segment, {self.segment_name} for some reason."
             )
 
+    def __snapshot_results(self):
+        """
+        Returns the stats and polygons of this segment for the result cache.
+        Rows are kept as json, with geometries as hex EWKB.
+        """
+        rows = {}
+        for table in RESULT_TABLES:
+            rows[table] = [
+                row[0]
+                for row in self.db.query(
+                    prepared(
+                        f"""
+                    select to_jsonb(a) - 'id' - 'username'
+                        || jsonb_build_object('geom', encode(st_asewkb(a.geom), 'hex'))
+                    from {self.results_schema}.{table} a
+                    where a.id = :id
+                    """
+                    ),
+                    {"id": self.study_segment_id},
+                )
+            ]
+        return {
+            "attributes": {key: getattr(self, key) for key in CACHED_ATTRIBUTES},
+            "rows": rows,
+        }
+
+    def __restore_cached_results(self, cached: dict):
+        """Writes cached polygons under this segment's id and sets its stats"""
+        for key, value in cached["attributes"].items():
+            setattr(self, key, value)
+
+        for table, rows in cached["rows"].items():
+            for row in rows:
+                self.db.execute(
+                    prepared(
+                        f"""
+                    insert into {self.results_schema}.{table}
+                    select (jsonb_populate_record(
+                        null::{self.results_schema}.{table},
+                        CAST(:row AS jsonb) || jsonb_build_object('id', CAST(:id AS integer), 'username', CAST(:username AS text))
+                    )).*
+                    """
+                    ),
+                    {
+                        "row": json.dumps(row),
+                        "id": self.study_segment_id,
+                        "username": self.username,
+                    },
+                )
+
     def __update_mileage(self):
         if self.has_isochrone is True:
             try:
                 query = f"""
-                select a.miles from {self.network_type}.user_isochrones a
-                inner join {self.network_type}.user_segments b
-                on a.id=b.id
-                where b.username = '{self.username}'
-                and b.seg_name= '{self.segment_name}'
+                select a.miles from {self.results_schema}.user_isochrones a
+                where a.id = :id
                 """
-                self.miles = self.db.query_as_singleton(query)
+                self.miles = self.db.query_as_singleton(
+                    prepared(query), {"id": self.study_segment_id}
+                )
             except Exception as e:
                 print(f"An error occurred: {e}")
                 print(f"Failed query: {query}")
                 raise RuntimeError(f"Error updating : {e}")
         else:
-            pass
+            self.miles = self.island_miles
 
     def __generate_mileage(self):
         """Returns the mileage of the segment or handles cases where mileage is nothing."""
@@ -513,11 +924,11 @@ class StudySegment:
 
         try:
             q = self.db.query_as_singleton(
-                f"""SELECT size_miles FROM {self.network_type}.user_islands a
-                    INNER JOIN {self.network_type}.user_segments b
-                    ON a.id = b.id
-                    WHERE b.seg_name = '{self.segment_name}'
-                    AND b.username = '{self.username}'"""
+                prepared(
+                    f"""SELECT size_miles FROM {self.results_schema}.user_islands a
+                    WHERE a.id = :id"""
+                ),
+                {"id": self.study_segment_id},
             )
         except IndexError:
             q = 0.0
@@ -528,7 +939,7 @@ class StudySegment:
         """
         Decides if isochrone should be created or not based on mileage of connected islands
         """
-        if self.miles > mileage:
+        if self.island_miles > mileage:
             print(f"mileage of nearby islands > {mileage}, creating isochrone")
 
             #TODO: Remove manual override when refactor complete
@@ -560,125 +971,66 @@ class StudySegment:
 
         print(f"pulling stat from {table} table, please wait..")
 
-        if self.has_isochrone is True:
-            polygon = f"{self.network_type}.user_isochrones"
-        elif self.has_isochrone is False:
-            polygon = f"{self.network_type}.user_blobs"
-
         # only report crashes on study segment- not in entire low-stress area around it
-        if table.endswith("crashes"):
-            polygon = f"{self.network_type}.user_buffers"
-        else:
-            pass
-
-        geom_type = geom_type.lower()
+        polygon = study_area(self.results_schema, self.has_isochrone, table)
+        q = prepared(stat_query(self.db, column, table, geom_type, polygon))
 
-        if geom_type == "polygon":
-            q = f"""
-                with total as(
-                    select round(st_area(st_intersection(a.geom, b.geom)) / st_area(a.geom) * a.{column}) as {column}_in_blobs
-                    from {table} a, {polygon} b
-                    where (st_intersects (a.geom, b.geom))
-                    and (b.id = {self.study_segment_id})
-                    and a.{column} >= 0)
-                select round(sum({column}_in_blobs)) from total
-        """
-            sum_poly = self.db.query_as_singleton(q)
-            if sum_poly is None:
-                return None
-            else:
-                return int(round(sum_poly, -2))
-
-        if geom_type == "point":
-            df = self.db.df(
-                f"""select count(a.{column}), a.{column} from {table} a, {polygon} b
-                    where st_intersects(a.geom, b.geom)
-                    and (b.id = {self.study_segment_id})
-                    group by a.{column}"""
+        if geom_type.lower() == "polygon":
+            return rounded(
+                self.db.query_as_singleton(q, {"id": self.study_segment_id})
             )
-            # zips up dataframe containing count by column attribute of point
-            df_dict = df.to_dict("records")
-            return df_dict
 
-        if geom_type == "line":
-            df = self.db.df(
-                f"""
-                select
-                    {column},
-                    sum(miles) as miles
-                from (
-                    select
-                        a.{column},
-                        st_length(a.geom)/1609 as miles
-                    from
-                        {table} a,
-                        {polygon} b
-                    where
-                        st_intersects(a.geom, b.geom)
-                        and (b.id = {self.study_segment_id})
-                ) as subquery
-                group by
-                    {column};
-                    """
-            )
-            df_dict = df.to_dict("records")
-            return df_dict
+        # zips up dataframe containing count by column attribute of point, or miles by line
+        df = self.db.df(q, {"id": self.study_segment_id})
+        return df.to_dict("records")
 
-    def pull_crashes(self, study_segment_id: int):
+    def pull_stats(
+        self,
+        study_segment_id: int,
+        columns: list,
+        table: str,
+    ):
         """
-        Grabs crash data from DVRPC's crash API for each polygon in a MultiPolygon GeoJSON.
+        grabs several attributes of a polygon table within the study area in one
+        overlay. the intersection area ratio is computed once per polygon and every
+        column is apportioned with it, returning a dict of column: value. values
+        match pull_stat(..., "polygon") for each column.
+
+        :param list columns: the columns you want to pull data from in your database
+        :param str table: the table you want to pull data from in your database
         """
 
-        geo = self.db.query(
-            f"""SELECT st_asgeojson(st_transform(st_union(geom), 4326))
-            FROM {self.network_type}.user_buffers
-            WHERE id = {study_segment_id}"""
-        )
-        geojson = json.loads(geo[0][0])
+        print(f"pulling {len(columns)} stats from {table} table, please wait..")
 
-        total_bike_crashes = 0
-        total_ped_crashes = 0
+        polygon = study_area(self.results_schema, self.has_isochrone)
+        q = stats_query(self.db, columns, table, polygon)
+        sums = self.db.query(prepared(q), {"id": self.study_segment_id})[0]
 
-        if geojson["type"] == "MultiPolygon":
-            for polygon in geojson["coordinates"]:
-                polygon_geojson = json.dumps(
-                    {"type": "Polygon", "coordinates": polygon}
-                )
+        return {column: rounded(value) for column, value in zip(columns, sums)}
 
-                r = requests.get(
-                    f"https://cloud.dvrpc.org/api/crash-data/v1/summary?geojson={polygon_geojson}"
-                )
-                data = r.json()
+    def pull_crashes(self, study_segment_id: int):
+        """
+        Grabs bike and pedestrian crash totals from DVRPC's crash API for the
+        segment's buffer. Each polygon of a MultiPolygon buffer is fetched at the
+        same time, and cached on disk, see crashes.py.
+        """
 
-                for year, year_data in data.items():
-                    try:
-                        if year_data["mode"]:
-                            total_bike_crashes += year_data["mode"].get("Bicyclists", 0)
-                            total_ped_crashes += year_data["mode"].get("Pedestrians", 0)
-                    except TypeError:
-                        print(year_data)
+        print("pulling crashes, please wait..")
 
-        else:
-            r = requests.get(
-                f"https://cloud.dvrpc.org/api/crash-data/v1/summary?geojson={geo[0][0]}"
-            )
-            try:
-                data = r.json()
-                for year, year_data in data.items():
-                    try:
-                        if year_data["mode"]:
-                            total_bike_crashes += year_data["mode"].get("Bicyclists", 0)
-                            total_ped_crashes += year_data["mode"].get("Pedestrians", 0)
-                    except TypeError:
-                        print(year_data)
-                total_crashes = {
-                    "Total Bike Crashes": total_bike_crashes,
-                    "Total Pedestrian Crashes": total_ped_crashes,
-                }
-                return [total_crashes]
-            except requests.exceptions.JSONDecodeError:
-                data = r
-                return ["error with crash api"]
+        geo = self.db.query_as_singleton(
+            prepared(
+                f"""SELECT st_asgeojson(st_transform(st_union(geom), 4326))
+            FROM {self.results_schema}.user_buffers
+            WHERE id = :id"""
+            ),
+            {"id": study_segment_id},
+        )
+
+        try:
+            return [get_crash_client().totals(json.loads(geo))]
+        except requests.exceptions.RequestException as e:
+            print(f"error with crash api: {e}")
+            return ["error with crash api"]
 
     def update_study_seg(self, column: str, value):
         """
@@ -689,32 +1041,36 @@ class StudySegment:
         """
 
         try:
-            if isinstance(value, str):
-                set_statement = f"set {column} = '{value}'"
-            elif isinstance(value, (int, float)):
-                set_statement = f"set {column} = {value}"
-            elif isinstance(value, list):
-                value = json.dumps(value)
-                set_statement = f"set {column} = '{value}'::json"
-            elif value is None:
-                set_statement = f"set {column} = NULL"
-            else:
-                value = json.dumps(value)
-                set_statement = f"set {column} = '{value}'::json"
-
-            query = f"""
-                update {self.network_type}.user_segments
-                {set_statement}
-                where id = {self.study_segment_id}
-                and username = '{self.username}'
-            """
-            self.db.execute(query)
+            apply_summaries(
+                self.db,
+                self.network_type,
+                [
+                    {
+                        "id": self.study_segment_id,
+                        "username": self.username,
+                        column: value,
+                    }
+                ],
+            )
         except Exception as e:
             print(f"An error occurred: {e}")
-            print(f"Failed query: {query}")
             raise RuntimeError(f"Error updating {column}: {e}")
 
+    def __store_metrics(self):
+        """Writes the instrumentation metrics to the segment's row"""
+        self.db.execute(
+            prepared(
+                f"""
+            update {self.network_type}.user_segments
+            set stage_metrics = CAST(:metrics AS json)
+            where id = :id
+            """
+            ),
+            {"metrics": self.instrumentation.to_json(), "id": self.study_segment_id},
+        )
+
     def summarize_stats(self):
+        """Writes every summary column of the segment in one update"""
         cols = {
             "network_type": self.network_type,
             "highest_comfort_level": self.highest_comfort_level,
@@ -735,7 +1091,7 @@ class StudySegment:
             "youth": self.youth,
             "circuit": self.circuit,
             "total_jobs": self.jobs,
-            "bike_ped_crashes": {'Total Bike Crashes': 0, 'Total Pedestrian Crashes': 0},
+            "bike_ped_crashes": self.bike_ped_crashes,
             "essential_services": self.essential_services,
             "rail_stations": self.rail_stations,
         }
@@ -743,8 +1099,11 @@ class StudySegment:
         if cols["highest_comfort_level"] is None or cols["highest_comfort_level"] == "":
             cols["highest_comfort_level"] = 0
 
-        for key, value in cols.items():
-            self.update_study_seg(key, value)
+        apply_summaries(
+            self.db,
+            self.network_type,
+            [{"id": self.study_segment_id, "username": self.username, **cols}],
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+"""
+crashes.py
+------------------
+Bike and pedestrian crash totals from DVRPC's crash API.
+
+The API summarizes the crashes inside one polygon by year and mode, so a study
+area's buffer takes a request per polygon. CrashClient sends them all at once
+on a pooled session, with a timeout and retries with backoff, and keeps every
+polygon's summary on disk keyed by a hash of the polygon, so a polygon is only
+fetched again once its summary expires.
+
+Crashes are only pulled in the pipeline with PULL_CRASHES=true in your .env
+file. benchmarks/crash_stub.py serves a stand-in for the API.
+
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .settings import (
+    CRASH_API_RETRIES,
+    CRASH_API_TIMEOUT,
+    CRASH_API_URL,
+    CRASH_API_WORKERS,
+    CRASH_CACHE_DIR,
+    CRASH_CACHE_MAX_AGE,
+)
+
+# reported when crashes aren't pulled
+NO_CRASHES = {"Total Bike Crashes": 0, "Total Pedestrian Crashes": 0}
+
+# responses worth retrying, on top of connection errors and timeouts
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_crash_client = None
+
+
+def polygons(geometry: dict):
+    """Returns the polygons of a Polygon or MultiPolygon GeoJSON geometry"""
+    if geometry["type"] == "MultiPolygon":
+        return [
+            {"type": "Polygon", "coordinates": coordinates}
+            for coordinates in geometry["coordinates"]
+        ]
+    return [geometry]
+
+
+def polygon_key(polygon: dict, url: str = CRASH_API_URL):
+    """Returns the cache key of a polygon's summary from the API at url"""
+    payload = json.dumps([polygon["coordinates"], url], separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def add_summary(totals: dict, summary: dict):
+    """Adds the bicyclist and pedestrian crashes of every year of a summary"""
+    for year, year_data in summary.items():
+        try:
+            if year_data["mode"]:
+                totals["Total Bike Crashes"] += year_data["mode"].get("Bicyclists", 0)
+                totals["Total Pedestrian Crashes"] += year_data["mode"].get(
+                    "Pedestrians", 0
+                )
+        except TypeError:
+            print(year_data)
+    return totals
+
+
+def get_crash_client():
+    """Returns the process-wide CrashClient, created from your .env settings"""
+    global _crash_client
+    if _crash_client is None:
+        _crash_client = CrashClient()
+    return _crash_client
+
+
+class CrashClient:
+    """
+    Fetches crash summaries per polygon, concurrently and cached on disk.
+
+    :param float timeout: seconds to wait for the API to connect and to respond
+    :param int retries: times a failed request is retried, with backoff
+    :param int workers: requests in flight at once, and pooled connections
+    :param str cache_dir: directory of cached summaries, None to not cache
+    :param int max_age: seconds a cached summary is used, None keeps them forever
+    """
+
+    def __init__(
+        self,
+        url: str = CRASH_API_URL,
+        timeout: float = CRASH_API_TIMEOUT,
+        retries: int = CRASH_API_RETRIES,
+        workers: int = CRASH_API_WORKERS,
+        cache_dir: str = CRASH_CACHE_DIR,
+        max_age: int = CRASH_CACHE_MAX_AGE,
+    ) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.max_age = max_age
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        adapter = HTTPAdapter(
+            pool_maxsize=workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["GET"]),
+            ),
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __cached(self, key: str):
+        if self.cache_dir is None:
+            return None
+        path = self.cache_dir / f"{key}.json"
+        try:
+            if self.max_age is not None:
+                if time.time() - path.stat().st_mtime > self.max_age:
+                    return None
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def __store(self, key: str, summary: dict):
+        if self.cache_dir is None:
+            return
+        path = self.cache_dir / f"{key}.json"
+        # written aside and renamed, so concurrent readers never see half a file
+        partial = path.with_suffix(f".{threading.get_ident()}.tmp")
+        partial.write_text(json.dumps(summary))
+        os.replace(partial, path)
+
+    def summary(self, polygon: dict):
+        """
+        Returns the API's summary of the crashes inside a GeoJSON polygon. Raises
+        requests.RequestException once every retry has failed.
+        """
+        key = polygon_key(polygon, self.url)
+        summary = self.__cached(key)
+        with self._lock:
+            if summary is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if summary is not None:
+            return summary
+
+        r = self.session.get(
+            self.url, params={"geojson": json.dumps(polygon)}, timeout=self.timeout
+        )
+        r.raise_for_status()
+        summary = r.json()
+        self.__store(key, summary)
+        return summary
+
+    def summaries(self, polygons: list):
+        """Returns the summary of every polygon, fetched at once"""
+        return list(self.executor.map(self.summary, polygons))
+
+    def totals(self, geometry: dict):
+        """Returns the bike and pedestrian crash totals inside a GeoJSON geometry"""
+        return self.totals_by_id({None: geometry})[None]
+
+    def totals_by_id(self, geometries: dict):
+        """
+        Returns the crash totals of several geometries, keyed like geometries.
+        The polygons of all of them are fetched at once.
+        """
+        parts = [
+            (key, polygon)
+            for key, geometry in geometries.items()
+            for polygon in polygons(geometry)
+        ]
+        totals = {key: dict(NO_CRASHES) for key in geometries}
+        summaries = self.summaries([polygon for _, polygon in parts])
+        for (key, _), summary in zip(parts, summaries):
+            add_summary(totals[key], summary)
+        return totals
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cache_dir": str(self.cache_dir) if self.cache_dir else None,
+        }
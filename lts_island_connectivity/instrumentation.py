@@ -0,0 +1,163 @@
+"""
+instrumentation.py
+------------------
+Per-stage timing and query plans for StudySegment.
+
+Pass an Instrumentation to StudySegment to record the wall time of every stage,
+plus the duration and row count of every query the stage runs. With
+explain=True each query runs as EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and its
+plan is kept too. Writes are only explained through execute(), where the
+EXPLAIN replaces the statement. query() and df() explain after running, so they
+skip writes (an INSERT ... RETURNING, say), which would otherwise run twice.
+Results come out as JSON, and with store=True they're also written to the
+stage_metrics column of the segment's user_segments row.
+
+"""
+
+import json
+import re
+import time
+from contextlib import contextmanager
+
+EXPLAINABLE = ("select", "insert", "update", "delete", "with")
+
+WRITES = re.compile(r"\b(insert|update|delete|merge)\b", re.IGNORECASE)
+
+
+def _explainable(query, params=None):
+    """
+    Only single select/insert/update/delete statements can be explained, and not
+    when they're executed for a list of parameters.
+    """
+    if isinstance(params, list):
+        return False
+    statement = str(query).strip().rstrip(";")
+    return statement.lower().startswith(EXPLAINABLE) and ";" not in statement
+
+
+def _read_only(query):
+    """Whether a statement only reads, so explaining it after running it is safe"""
+    statement = str(query).strip().lower()
+    if statement.startswith("select"):
+        return True
+    return statement.startswith("with") and not WRITES.search(statement)
+
+
+def _plan_rows(plan: dict):
+    """Actual rows of a plan, using the input of insert/update/delete nodes"""
+    node = plan["Plan"]
+    if node["Node Type"] == "ModifyTable" and node.get("Plans"):
+        node = node["Plans"][0]
+    return node["Actual Rows"] * node.get("Actual Loops", 1)
+
+
+class Instrumentation:
+    """
+    Collects stage and query metrics for one segment.
+
+    :param bool explain: capture EXPLAIN (ANALYZE, BUFFERS) plans for every query
+    :param bool store: write the metrics to user_segments.stage_metrics
+    """
+
+    def __init__(self, explain: bool = False, store: bool = False):
+        self.explain = explain
+        self.store = store
+        self.stages = []
+        self._current = None
+
+    @contextmanager
+    def stage(self, name: str):
+        record = {"stage": name, "seconds": None, "queries": []}
+        self.stages.append(record)
+        previous, self._current = self._current, record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 4)
+            self._current = previous
+
+    def record_query(self, query: str, seconds: float, rows: int, plan=None):
+        if self._current is None:
+            return
+        record = {"sql": " ".join(str(query).split()), "seconds": round(seconds, 4)}
+        record["rows"] = rows
+        if plan is not None:
+            record["plan"] = plan
+        self._current["queries"].append(record)
+
+    def to_dict(self):
+        return {
+            "seconds": round(sum(stage["seconds"] or 0 for stage in self.stages), 4),
+            "stages": self.stages,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), default=str, **kwargs)
+
+
+class InstrumentedDatabase:
+    """
+    Wraps a PooledDatabase, recording every query against the current stage of an
+    Instrumentation.
+    """
+
+    def __init__(self, db, instrumentation: Instrumentation):
+        self.db = db
+        self.uri = db.uri
+        self.engine = db.engine
+        self.instrumentation = instrumentation
+
+    def __explain(self, query, params: dict = None):
+        plan = self.db.query(
+            f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params
+        )[0][0]
+        return plan[0]
+
+    def __explain_after(self, query, params=None):
+        # query() and df() explain after running, which would repeat a write
+        return (
+            self.instrumentation.explain
+            and _explainable(query, params)
+            and _read_only(query)
+        )
+
+    def savepoint(self):
+        return self.db.savepoint()
+
+    def execute(self, query, params=None):
+        start = time.perf_counter()
+        if self.instrumentation.explain and _explainable(query, params):
+            # EXPLAIN ANALYZE runs the statement, so it replaces the execute
+            plan = self.__explain(query, params)
+            rows = _plan_rows(plan)
+        else:
+            plan = None
+            rows = self.db.execute(query, params)
+        self.instrumentation.record_query(
+            query, time.perf_counter() - start, rows, plan
+        )
+        return rows
+
+    def query(self, query, params: dict = None):
+        start = time.perf_counter()
+        result = self.db.query(query, params)
+        seconds = time.perf_counter() - start
+        plan = None
+        if self.__explain_after(query, params):
+            plan = self.__explain(query, params)
+        self.instrumentation.record_query(query, seconds, len(result), plan)
+        return result
+
+    def query_as_singleton(self, query, params: dict = None):
+        return self.query(query, params)[0][0]
+
+    def df(self, query, params: dict = None):
+        start = time.perf_counter()
+        result = self.db.df(query, params)
+        seconds = time.perf_counter() - start
+        plan = None
+        if self.__explain_after(query, params):
+            plan = self.__explain(query, params)
+        self.instrumentation.record_query(query, seconds, len(result), plan)
+        return result
@@ -0,0 +1,248 @@
+"""
+island_graph.py
+------------------
+Scores candidate segments against the islands of a network in memory.
+
+A segment's benefit comes from the islands its 30m buffer touches. IslandGraph
+loads each island once, with its mileage and the stats pre-aggregated over its
+footprint by build_island_stats, and indexes the islands in an STRtree. Scoring
+a candidate is then a tree query and a sum, and many candidates together are
+scored by merging the islands they join in a union-find.
+
+Island stats are summed per island, so areas where footprints overlap count
+once per island. Use the scores to rank candidates, and run StudySegment on the
+ones you keep for exact numbers.
+
+"""
+
+from collections import Counter
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely.geometry import shape
+from .connections import DEMOGRAPHIC_COLUMNS, network_tables
+from .islands import connected_components
+from .refresh import cache_version
+
+# numeric stats pre-aggregated per island
+ISLAND_STATS = [*DEMOGRAPHIC_COLUMNS, "total_jobs"]
+
+# point counts per type, pre-aggregated per island as json
+ISLAND_COUNTS = {
+    "essential_services": "essential_services",
+    "rail_stations": "passengerrailstations",
+}
+
+_to_network_crs = Transformer.from_crs(4326, 26918, always_xy=True)
+
+_graphs = {}
+
+
+def islands_table(network_type: str, highest_comfort_level: int = 2):
+    hcl = network_tables(network_type, highest_comfort_level)[0]
+    return f"{network_type}.{network_type}{hcl}_islands"
+
+
+def build_island_stats(db, islands: str):
+    """
+    Creates the {islands}_stats table: the mileage of every island, plus its
+    demographics and jobs apportioned by area, and its essential services and
+    rail stations counted by type, over the island's 100m footprint from
+    {islands}_buffers (the same buffer blobs are made of).
+
+    :param str islands: the islands table, ie lts.lts2_islands
+    """
+    print(f"pre-aggregating stats of {islands}, please wait..")
+
+    apportioned = ",\n".join(
+        f"round(sum(case when d.{column} >= 0 then ratio * d.{column} end)) as {column}"
+        for column in DEMOGRAPHIC_COLUMNS
+    )
+    counts = ",\n".join(
+        f"""{name} as (
+                select uid, jsonb_object_agg(type, count) as {name}
+                from (
+                    select f.uid, p.type, count(*)
+                    from footprints f
+                    inner join {table} p on st_intersects(p.geom, f.geom)
+                    group by f.uid, p.type
+                ) as counted
+                group by uid
+            )"""
+        for name, table in ISLAND_COUNTS.items()
+    )
+    db.execute(
+        f"""
+        drop table if exists {islands}_stats;
+        create table {islands}_stats as
+        with footprints as (
+            select a.uid, a.size_miles, b.geom
+            from {islands} a
+            inner join {islands}_buffers b on a.uid = b.uid
+        ),
+        demographics as (
+            select uid, {apportioned}
+            from (
+                select f.uid, st_area(st_intersection(d.geom, f.geom)) / st_area(d.geom) as ratio, d.*
+                from footprints f
+                inner join censustract2020_demographics d on st_intersects(d.geom, f.geom)
+            ) as d
+            group by uid
+        ),
+        jobs as (
+            select f.uid, round(sum(st_area(st_intersection(j.geom, f.geom)) / st_area(j.geom) * j.total_jobs)) as total_jobs
+            from footprints f
+            inner join lodes_2020 j on st_intersects(j.geom, f.geom)
+            where j.total_jobs >= 0
+            group by f.uid
+        ),
+        {counts}
+        select
+            f.uid,
+            f.size_miles,
+            {", ".join(f"coalesce(d.{column}, 0) as {column}" for column in DEMOGRAPHIC_COLUMNS)},
+            coalesce(j.total_jobs, 0) as total_jobs,
+            {", ".join(f"coalesce({name}.{name}, '{{}}'::jsonb) as {name}" for name in ISLAND_COUNTS)}
+        from footprints f
+        left join demographics d on f.uid = d.uid
+        left join jobs j on f.uid = j.uid
+        {" ".join(f"left join {name} on f.uid = {name}.uid" for name in ISLAND_COUNTS)};
+        alter table {islands}_stats add primary key (uid);
+        """
+    )
+
+
+def get_island_graph(db, network_type: str, highest_comfort_level: int = 2):
+    """
+    Returns the IslandGraph of a network and comfort level, loading it from the
+    database the first time it is asked for in this process, and again after
+    network_islands.py rebuilds its islands or their stats.
+    """
+    key = (db.uri, network_type, network_tables(network_type, highest_comfort_level)[0])
+    islands = islands_table(network_type, highest_comfort_level)
+    version = cache_version(db, [islands, f"{islands}_stats"])
+    if key not in _graphs or _graphs[key][0] != version:
+        graph = IslandGraph.load(db, network_type, highest_comfort_level)
+        _graphs[key] = (version, graph)
+    return _graphs[key][1]
+
+
+def to_network_crs(geometry: dict):
+    """Returns a GeoJSON geometry in EPSG:4326 as a shapely geometry in EPSG:26918"""
+    return shapely.transform(
+        shape(geometry),
+        lambda coords: np.column_stack(
+            _to_network_crs.transform(coords[:, 0], coords[:, 1])
+        ),
+    )
+
+
+class IslandGraph:
+    """
+    The islands of one network and comfort level, with their mileage and stats.
+
+    :param uids: island uids
+    :param geometries: shapely geometries of the islands, in EPSG:26918
+    :param miles: size_miles of each island
+    :param stats: (islands, ISLAND_STATS) array of pre-aggregated stats
+    :param counts: {name: [dict of type: count per island]} for ISLAND_COUNTS
+    """
+
+    def __init__(self, uids, geometries, miles, stats, counts):
+        self.uids = np.asarray(uids)
+        self.geometries = np.asarray(geometries)
+        self.miles = np.asarray(miles, dtype=np.float64)
+        self.stats = np.asarray(stats, dtype=np.float64).reshape(len(self.uids), -1)
+        self.counts = counts
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def load(cls, db, network_type: str, highest_comfort_level: int = 2):
+        """Loads the islands and their stats table, see build_island_stats"""
+        islands = islands_table(network_type, highest_comfort_level)
+        print(f"loading {islands} into memory, please wait..")
+        rows = db.query(
+            f"""
+            select a.uid, st_asbinary(a.geom), b.size_miles,
+                {", ".join(f"b.{column}" for column in ISLAND_STATS)},
+                {", ".join(f"b.{name}" for name in ISLAND_COUNTS)}
+            from {islands} a
+            inner join {islands}_stats b on a.uid = b.uid
+            order by a.uid
+            """
+        )
+        stats_end = 3 + len(ISLAND_STATS)
+        return cls(
+            [row[0] for row in rows],
+            shapely.from_wkb([bytes(row[1]) for row in rows]),
+            [row[2] for row in rows],
+            [[value or 0 for value in row[3:stats_end]] for row in rows],
+            {
+                name: [row[stats_end + i] or {} for row in rows]
+                for i, name in enumerate(ISLAND_COUNTS)
+            },
+        )
+
+    def touching(self, geometries, distance: float = 30):
+        """
+        Returns, for each geometry (EPSG:26918), the indices of the islands its
+        buffer intersects, like __generate_proximate_islands.
+        """
+        buffers = shapely.buffer(np.asarray(geometries), distance)
+        candidate, island = self.tree.query(buffers, predicate="intersects")
+        order = np.argsort(candidate, kind="stable")
+        candidate, island = candidate[order], island[order]
+        splits = np.searchsorted(candidate, np.arange(1, len(buffers)))
+        return np.split(island, splits)
+
+    def summarize(self, islands):
+        """Sums the mileage and stats of a set of island indices"""
+        islands = np.unique(islands)
+        summary = {
+            "islands": self.uids[islands].tolist(),
+            "miles": float(self.miles[islands].sum()),
+        }
+        totals = self.stats[islands].sum(axis=0)
+        for column, value in zip(ISLAND_STATS, totals):
+            summary[column] = int(value)
+        for name, per_island in self.counts.items():
+            counted = Counter()
+            for index in islands:
+                counted.update(per_island[index])
+            summary[name] = dict(counted)
+        return summary
+
+    def score(self, geometries, distance: float = 30):
+        """Scores each geometry on its own, returning a summary per geometry"""
+        return [
+            self.summarize(islands) for islands in self.touching(geometries, distance)
+        ]
+
+    def combine(self, geometries, distance: float = 30):
+        """
+        Scores geometries built together. Islands joined by any geometry are merged
+        in a union-find, so a chain of segments connects everything along it.
+        Returns a summary per merged component, largest mileage first, with the
+        indices of the geometries that built it.
+        """
+        sources, targets, owners = [], [], []
+        for index, islands in enumerate(self.touching(geometries, distance)):
+            if len(islands):
+                sources.append(np.full(len(islands), islands[0]))
+                targets.append(islands)
+                owners.append((index, islands[0]))
+        if not owners:
+            return []
+        labels = connected_components(
+            len(self.uids), np.concatenate(sources), np.concatenate(targets)
+        )
+
+        components = {}
+        for index, island in owners:
+            components.setdefault(labels[island], []).append(index)
+        summaries = []
+        for label, built_by in components.items():
+            summary = self.summarize(np.nonzero(labels == label)[0])
+            summary["segments"] = built_by
+            summaries.append(summary)
+        return sorted(summaries, key=lambda summary: summary["miles"], reverse=True)
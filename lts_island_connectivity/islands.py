@@ -0,0 +1,211 @@
+"""
+islands.py
+------------------
+Builds the islands of a low stress network in Python.
+
+An island is a connected component of the network: segments that share an
+endpoint belong to the same island. Endpoints are snapped to a grid with the
+same 0.0005 tolerance pgr_createTopology uses, and components are found with a
+union-find over NumPy arrays, so only the endpoints leave the database and a
+full region takes seconds. The labels are sent back with COPY.
+
+"""
+
+import io
+import numpy as np
+from sqlalchemy import text
+from .settings import ISLAND_BUFFER_SIMPLIFY
+
+# same tolerance as pgr_createTopology in network_islands.py
+SNAP_TOLERANCE = 0.0005
+
+# the conversion every mileage in the package uses, island and segment alike
+METERS_PER_MILE = 1609
+
+# distance blobs extend around their islands
+BLOB_DISTANCE = 100
+
+
+def snap_endpoints(xy, tolerance: float = SNAP_TOLERANCE):
+    """
+    Returns a vertex index for every point of an (n, 2) array. Points in the same
+    grid cell of size tolerance share a vertex, and so do points in neighbouring
+    cells when their cells' first points are within tolerance of each other.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    if not len(xy):
+        return np.zeros(0, dtype=np.int64)
+
+    cells = np.floor(xy / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    width = cells[:, 1].max() + 2
+    keys = cells[:, 0] * width + cells[:, 1]
+    unique_keys, first, vertex = np.unique(keys, return_index=True, return_inverse=True)
+    vertex = vertex.ravel()
+
+    # points either side of a grid line can still be within tolerance
+    sources, targets = [], []
+    for dx, dy in [(1, -1), (1, 0), (1, 1), (0, 1)]:
+        neighbours = unique_keys + dx * width + dy
+        position = np.searchsorted(unique_keys, neighbours)
+        position[position == len(unique_keys)] = 0
+        found = unique_keys[position] == neighbours
+        cell, neighbour = np.nonzero(found)[0], position[found]
+        distance = np.hypot(*(xy[first[cell]] - xy[first[neighbour]]).T)
+        close = distance <= tolerance
+        sources.append(cell[close])
+        targets.append(neighbour[close])
+    merged = connected_components(
+        len(unique_keys), np.concatenate(sources), np.concatenate(targets)
+    )
+    return merged[vertex]
+
+
+def connected_components(count: int, sources, targets):
+    """
+    Returns the component label of nodes 0..count-1 joined by the given edges.
+    Every label is the smallest node of its component.
+
+    Union-find over whole arrays: each round hooks the larger root of every edge
+    whose ends are in different components onto the smaller one, then compresses
+    paths until every node points at its root.
+    """
+    parent = np.arange(count, dtype=np.int64)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+
+    while len(sources):
+        source_roots, target_roots = parent[sources], parent[targets]
+        low = np.minimum(source_roots, target_roots)
+        high = np.maximum(source_roots, target_roots)
+        split = low != high
+        if not split.any():
+            break
+        np.minimum.at(parent, high[split], low[split])
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        # edges inside a single component can't merge anything again
+        sources, targets = sources[split], targets[split]
+
+    return parent
+
+
+def label_segments(ids, start_xy, end_xy, tolerance: float = SNAP_TOLERANCE):
+    """
+    Returns the island label of each segment. Rows that share an id are parts of
+    the same feature, and are kept on the same island.
+    """
+    ids = np.asarray(ids)
+    count = len(ids)
+    vertex = snap_endpoints(np.concatenate([start_xy, end_xy]), tolerance)
+
+    # nodes are the segments, then the snapped vertices. each segment is joined to
+    # its two endpoints, and to the first row with its id
+    _, first_row, same_id = np.unique(ids, return_index=True, return_inverse=True)
+    rows = np.arange(count)
+    sources = np.concatenate([rows, rows, rows])
+    targets = np.concatenate(
+        [count + vertex[:count], count + vertex[count:], first_row[same_id.ravel()]]
+    )
+    labels = connected_components(count + vertex.max() + 1, sources, targets)
+    return labels[:count]
+
+
+def generate_islands(
+    db,
+    tablename: str,
+    uid: str,
+    output_tablename: str,
+    schema: str,
+    tolerance: float = SNAP_TOLERANCE,
+):
+    """
+    Creates {schema}.{output_tablename} with one row per island of tablename: a uid,
+    the island's segments as a MultiLineString, and its length as size_miles.
+
+    :param str tablename: the network table, ie lts.lts_stress_below_3
+    :param str uid: the id column of the network table
+    """
+    print(f"generating islands of {tablename}, please wait..")
+
+    rows = db.query(
+        f"""
+        select
+            a.{uid},
+            st_x(st_startpoint(d.geom)), st_y(st_startpoint(d.geom)),
+            st_x(st_endpoint(d.geom)), st_y(st_endpoint(d.geom))
+        from {tablename} a, lateral st_dump(a.geom) d
+        where a.{uid} is not null
+        """
+    )
+    if rows:
+        table = np.array(rows, dtype=np.float64)
+        ids = table[:, 0].astype(np.int64)
+        labels = label_segments(ids, table[:, 1:3], table[:, 3:5], tolerance)
+    else:
+        ids = labels = np.zeros(0, dtype=np.int64)
+
+    labels_file = io.StringIO()
+    np.savetxt(labels_file, np.column_stack([ids, labels]), fmt="%d", delimiter="\t")
+    labels_file.seek(0)
+
+    output = f"{schema}.{output_tablename}"
+    with db.engine.begin() as connection:
+        connection.execute(
+            text(
+                f"""
+                drop table if exists {output};
+                create temporary table island_labels (id bigint, label bigint)
+                on commit drop;
+                """
+            )
+        )
+        # streamed in one COPY, rather than inlined into the statement as arrays
+        cursor = connection.connection.cursor()
+        cursor.copy_expert("copy island_labels from stdin", labels_file)
+        cursor.close()
+        connection.execute(
+            text(
+                f"""
+                create table {output} as
+                    select
+                        row_number() over (order by min(b.id))::integer as uid,
+                        st_collectionextract(st_collect(a.geom), 2) as geom,
+                        sum(st_length(a.geom)) / {METERS_PER_MILE} as size_miles
+                    from {tablename} a
+                    inner join (select distinct id, label from island_labels) b
+                    on a.{uid} = b.id
+                    group by b.label;
+                alter table {output} add primary key (uid);
+                create index on {output} using gist (geom);
+                """
+            )
+        )
+
+
+def build_island_buffers(db, islands: str, simplify: float = ISLAND_BUFFER_SIMPLIFY):
+    """
+    Creates {islands}_buffers with the 100m buffer of every island, the footprint
+    blobs are made of, so segments only union a few of these at request time.
+
+    :param str islands: the islands table, ie lts.lts2_islands
+    :param float simplify: tolerance in meters to simplify the buffers by, 0 to
+        keep them exact
+    """
+    print(f"buffering {islands}, please wait..")
+
+    footprint = f"st_buffer(geom, {BLOB_DISTANCE})"
+    if simplify:
+        footprint = f"st_simplifypreservetopology({footprint}, {simplify})"
+    db.execute(
+        f"""
+        drop table if exists {islands}_buffers;
+        create table {islands}_buffers as
+            select uid, {footprint} as geom from {islands};
+        alter table {islands}_buffers add primary key (uid);
+        create index on {islands}_buffers using gist (geom);
+        """
+    )
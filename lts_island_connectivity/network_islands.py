@@ -1,80 +1,232 @@
-from network_routing.gaps.segments.generate_islands import generate_islands
-from pg_data_etl import Database
+"""
+network_islands.py
+------------------
+Builds the pgRouting topology and low stress networks of the lts and sidewalk
+networks, then their low stress islands. Run after bh_firewall_read_data.py
+(see `make islands`). The lts_stress_below_{N} tables are only built here.
 
-db = Database.from_config("localhost")
+Islands and topology are only rebuilt when the tables they're built from were
+reimported since the last build, see refresh.py. Pass --full-refresh to rebuild
+everything.
 
+    python -m lts_island_connectivity.network_islands
 
-generate_islands(db, "sidewalk.ped_network", "objectid", "sidewalk_islands", "sidewalk")
-generate_islands(
-    db,
-    "lts.lts_stress_below_2",
-    "dvrpc_id",
-    "lts1_islands",
-    "lts",
-)  # generates islands composed of lts 2, 3, and 4 segments
-generate_islands(
-    db,
-    "lts.lts_stress_below_3",
-    "dvrpc_id",
-    "lts2_islands",
-    "lts",
-)  # generates islands composed of lts 3, 4 segments
-generate_islands(
-    db, "lts.lts_stress_below_4", "dvrpc_id", "lts3_islands", "lts"
-)  # generates islands only of lts 4 segments
-
-gapslist = [1, 2, 3]
-for value in gapslist:
-    stressbelow = value + 1
+"""
+
+import sys
+from lts_island_connectivity.island_graph import build_island_stats
+from lts_island_connectivity.islands import (
+    METERS_PER_MILE,
+    build_island_buffers,
+    generate_islands,
+)
+from lts_island_connectivity.settings import ISLAND_BUFFER_SIMPLIFY
+from lts_island_connectivity.pool import get_database
+from lts_island_connectivity.refresh import (
+    derived_signature,
+    needs_refresh,
+    setup_refresh_state,
+    store_signature,
+)
+
+# low stress table, id column, islands table and schema of each network
+ISLANDS = [
+    ("sidewalk.ped_network", "objectid", "sidewalk_islands", "sidewalk"),
+    # islands composed of lts 2, 3, and 4 segments
+    ("lts.lts_stress_below_2", "dvrpc_id", "lts1_islands", "lts"),
+    # islands composed of lts 3, 4 segments
+    ("lts.lts_stress_below_3", "dvrpc_id", "lts2_islands", "lts"),
+    # islands only of lts 4 segments
+    ("lts.lts_stress_below_4", "dvrpc_id", "lts3_islands", "lts"),
+]
+
+# overlay layers the island stats are aggregated from
+ISLAND_STATS_INPUTS = [
+    "censustract2020_demographics",
+    "lodes_2020",
+    "essential_services",
+    "passengerrailstations",
+]
+
+
+def build_islands(db, islands: list = ISLANDS):
+    """Generates the islands of every network, see islands.py"""
+    for ls_table, ids, islands_table, schema in islands:
+        generate_islands(db, ls_table, ids, islands_table, schema)
+
+
+def build_full_lts_topology(db):
+    """
+    Creates the topology and pgrouting costs of lts.lts_full, once for every
+    comfort level. Each level is a subset of lts_full, see build_lts_topology.
+    """
+    db.execute(
+        """
+            alter table lts.lts_full add column if not exists source integer;
+            alter table lts.lts_full add column if not exists target integer;
+            select pgr_createTopology('lts.lts_full', 0.0005, 'geom', 'dvrpc_id', clean := true);
+            --adds info needed for pgrouting. geom is imported in EPSG:26918, so it's already in meters
+            alter table lts.lts_full add column if not exists length_m integer;
+            alter table lts.lts_full add column if not exists traveltime_min double precision;
+            update lts.lts_full set
+                length_m = round(st_length(geom)),
+                traveltime_min = round(st_length(geom)) / 16000.0 * 60; -- 16 kms per hr, about 10 mph. low range of beginner cyclist speeds
+            """
+    )
+
+
+def build_all_island_buffers(db, islands: list = ISLANDS):
+    """Precomputes the 100m buffers blobs are made of, see islands.py"""
+    for _, _, islands_table, schema in islands:
+        build_island_buffers(db, f"{schema}.{islands_table}")
+
+
+def build_all_island_stats(db, islands: list = ISLANDS):
+    """Pre-aggregates the stats of every network's islands, see island_graph.py"""
+    for _, _, islands_table, schema in islands:
+        build_island_stats(db, f"{schema}.{islands_table}")
+
+
+def build_lts_topology(db, gapslist: tuple = (1, 2, 3)):
+    """
+    Creates the gaps tables, network and nodes of each LTS comfort level.
+    Each level's network is taken from lts.lts_full with its source, target and
+    costs, so node ids are the same at every level. Run build_full_lts_topology
+    first.
+    """
+    for value in gapslist:
+        stressbelow = value + 1
+        db.execute(
+            f"""drop table if exists lts.lts{value}gaps CASCADE;
+                create table lts.lts{value}gaps as select * from lts.lts_full lf where lf.lts_score::int > {value};
+                drop table if exists lts.lts_stress_below_{stressbelow} CASCADE;
+                create table lts.lts_stress_below_{stressbelow} as
+                    select * from lts.lts_full where lts_score::int < {stressbelow};
+                create index on lts.lts_stress_below_{stressbelow} using gist (geom);
+                create or replace view lts.lts{stressbelow}nodes as
+                    select id, st_centroid(st_collect(pt)) as geom
+                    from (
+                        (select source as id, st_startpoint(geom) as pt
+                        from lts.lts_stress_below_{stressbelow}
+                        )
+                    union
+                    (select target as id, st_endpoint(geom) as pt
+                    from lts.lts_stress_below_{stressbelow}
+                    )
+                    ) as foo
+                    group by id;
+                """
+        )
+
+
+def build_sidewalk_topology(db):
+    """Creates the topology and nodes of the sidewalk network"""
     db.execute(
-        f"""drop table if exists lts.lts{value}gaps CASCADE;
-            create table lts.lts{value}gaps as select * from lts.lts_full lf where lf.lts_score::int > {value};
-            alter table lts.lts_stress_below_{stressbelow} add column if not exists source integer;
-            alter table lts.lts_stress_below_{stressbelow} add column if not exists target integer;
-            select pgr_createTopology('lts.lts_stress_below_{stressbelow}', 0.0005, 'geom', 'dvrpc_id');
-            create or replace view lts.lts{stressbelow}nodes as
+        """
+            alter table sidewalk.ped_network add column if not exists source integer;
+            alter table sidewalk.ped_network add column if not exists target integer;
+            select pgr_createTopology('sidewalk.ped_network', 0.0005, 'geom', 'objectid');
+            create or replace view sidewalk.sidewalknodes as 
                 select id, st_centroid(st_collect(pt)) as geom
                 from (
                     (select source as id, st_startpoint(geom) as pt
-                    from lts.lts_stress_below_{stressbelow}
-                    )
+                    from sidewalk.ped_network
+                    ) 
                 union
                 (select target as id, st_endpoint(geom) as pt
-                from lts.lts_stress_below_{stressbelow}
-                )
+                from sidewalk.ped_network
+                ) 
                 ) as foo
                 group by id;
-            --adds info needed for pgrouting
-            alter table lts.lts_stress_below_{stressbelow} add column if not exists length_m integer;
-            update lts.lts_stress_below_{stressbelow} set length_m = st_length(st_transform(geom,26918));
-            alter table lts.lts_stress_below_{stressbelow} add column if not exists traveltime_min double precision;
-            update lts.lts_stress_below_{stressbelow} set traveltime_min = length_m  / 16000.0 * 60; -- 16 kms per hr, about 10 mph. low range of beginner cyclist speeds
+            --adds info needed for pgrouting. geom is imported in EPSG:26918, so it's already in meters
+            alter table sidewalk.ped_network add column if not exists length_m integer;
+            alter table sidewalk.ped_network add column if not exists traveltime_min double precision;
+            update sidewalk.ped_network set
+                length_m = round(st_length(geom)),
+                traveltime_min = round(st_length(geom)) / 4820.0 * 60; -- 4.82 kms per hr, about 3 mph. walking speed.
 
             """
     )
 
-db.execute(
+
+def refresh(
+    db,
+    tablename: str,
+    inputs: list,
+    build,
+    full_refresh: bool = False,
+    parameters: dict = None,
+):
+    """
+    Runs build if the inputs of tablename, or the parameters it's built with,
+    changed since it was last built
+    """
+    signature = derived_signature(db, inputs, parameters)
+    if not needs_refresh(db, tablename, signature, full_refresh):
+        print(f"{tablename} is up to date, skipping..")
+        return
+    build()
+    if signature is not None:
+        store_signature(db, tablename, signature)
+
+
+def build_all(db, full_refresh: bool = False):
     """
-        alter table sidewalk.ped_network add column if not exists source integer;
-        alter table sidewalk.ped_network add column if not exists target integer;
-        select pgr_createTopology('sidewalk.ped_network', 0.0005, 'geom', 'objectid');
-        create or replace view sidewalk.sidewalknodes as 
-            select id, st_centroid(st_collect(pt)) as geom
-            from (
-                (select source as id, st_startpoint(geom) as pt
-                from sidewalk.ped_network
-                ) 
-            union
-            (select target as id, st_endpoint(geom) as pt
-            from sidewalk.ped_network
-            ) 
-            ) as foo
-            group by id;
-        --adds info needed for pgrouting
-        alter table sidewalk.ped_network add column if not exists length_m integer;
-        update sidewalk.ped_network set length_m = st_length(st_transform(geom,26918));
-        alter table sidewalk.ped_network add column if not exists traveltime_min double precision;
-        update sidewalk.ped_network set traveltime_min = length_m  / 4820.0 * 60; -- 4.82 kms per hr, about 3 mph. walking speed.
+    Builds the topology, then the low stress networks, then the islands with
+    their buffers and stats, each only if its inputs changed (see refresh)
+    """
+    setup_refresh_state(db)
+    refresh(
+        db,
+        "lts.lts_full_vertices_pgr",
+        ["lts.lts_full"],
+        lambda: build_full_lts_topology(db),
+        full_refresh,
+    )
+    for value in [1, 2, 3]:
+        # the islands of each comfort level are built from this table
+        refresh(
+            db,
+            f"lts.lts_stress_below_{value + 1}",
+            ["lts.lts_full_vertices_pgr"],
+            lambda: build_lts_topology(db, [value]),
+            full_refresh,
+        )
+    refresh(
+        db,
+        "sidewalk.sidewalknodes",
+        ["sidewalk.ped_network"],
+        lambda: build_sidewalk_topology(db),
+        full_refresh,
+    )
+    for island in ISLANDS:
+        ls_table, _, islands_table, schema = island
+        refresh(
+            db,
+            f"{schema}.{islands_table}",
+            [ls_table],
+            lambda: build_islands(db, [island]),
+            full_refresh,
+            {"meters_per_mile": METERS_PER_MILE},
+        )
+        refresh(
+            db,
+            f"{schema}.{islands_table}_buffers",
+            [f"{schema}.{islands_table}"],
+            lambda: build_all_island_buffers(db, [island]),
+            full_refresh,
+            {"simplify": ISLAND_BUFFER_SIMPLIFY},
+        )
+        refresh(
+            db,
+            f"{schema}.{islands_table}_stats",
+            [f"{schema}.{islands_table}_buffers", *ISLAND_STATS_INPUTS],
+            lambda: build_all_island_stats(db, [island]),
+            full_refresh,
+        )
 
-        """
-)
+
+if __name__ == "__main__":
+    full_refresh = "--full-refresh" in sys.argv
+    db = get_database("localhost")
+    build_all(db, full_refresh)
@@ -0,0 +1,131 @@
+"""
+overlays.py
+------------------
+Subdivided working copies of the large polygon layers the stats come from.
+
+Census tracts, lodes tracts and land use parcels can be huge, complex polygons,
+so a GiST index barely narrows down which ones a blob or isochrone touches, and
+every st_intersection runs on the whole polygon. build_subdivided splits a
+layer with ST_Subdivide into {table}_subdivided, where every piece keeps its
+parent's ogc_fid, attributes and area.
+
+overlay() and intersecting() write the overlay queries of StudySegment and
+BatchStudySegments against the subdivided copy when it exists, and against the
+layer itself otherwise, with the same results.
+
+"""
+
+from .refresh import cache_version
+from .settings import SUBDIVIDE_MAX_VERTICES
+from .statements import prepared
+
+# layers with subdivided copies, built by bh_firewall_read_data.py
+SUBDIVIDED_LAYERS = ["censustract2020_demographics", "lodes_2020", "landuse_2015"]
+
+_subdivided = {}
+
+
+def build_subdivided(db, table: str, max_vertices: int = SUBDIVIDE_MAX_VERTICES):
+    """
+    Creates {table}_subdivided, pieces of at most max_vertices vertices with the
+    ogc_fid, attributes and area (parent_area) of the polygon they came from.
+    Tables imported by ogr2ogr already have ogc_fid, it's added if missing.
+    """
+    print(f"subdividing {table}, please wait..")
+
+    db.execute(
+        f"""
+        alter table {table} add column if not exists ogc_fid serial;
+        create index if not exists {table}_ogc_fid_idx on {table} (ogc_fid);
+        """
+    )
+    columns = [
+        row[0]
+        for row in db.query(
+            prepared(
+                """
+                select attname from pg_attribute
+                where attrelid = CAST(:table AS regclass)
+                and attnum > 0
+                and not attisdropped
+                and attname <> 'geom'
+                order by attnum
+                """
+            ),
+            {"table": table},
+        )
+    ]
+    db.execute(
+        f"""
+        drop table if exists {table}_subdivided;
+        create table {table}_subdivided as
+            select {", ".join(columns)}, st_area(geom) as parent_area,
+            st_subdivide(geom, {max_vertices}) as geom
+            from {table};
+        create index on {table}_subdivided using gist (geom);
+        analyze {table}_subdivided;
+        """
+    )
+    _subdivided.pop((db.uri, table), None)
+
+
+def subdivided(db, table: str):
+    """
+    Whether table has a subdivided copy, checked once per process and again
+    after the copy is rebuilt
+    """
+    key = (db.uri, table)
+    version = cache_version(db, [f"{table}_subdivided"])
+    if key not in _subdivided or _subdivided[key][0] != version:
+        exists = db.query_as_singleton(
+            prepared("select to_regclass(:table) is not null"),
+            {"table": f"{table}_subdivided"},
+        )
+        _subdivided[key] = (version, exists)
+    return _subdivided[key][1]
+
+
+def overlay(db, table: str, columns: list, polygon: str, where: str = "true"):
+    """
+    Returns a subquery of (id, ratio, *columns): every polygon of table that
+    intersects a study area of polygon, with the share of its area inside it.
+    On a subdivided copy the pieces of each polygon are summed back up first.
+
+    :param str polygon: table or subquery of study areas, with id and geom
+    :param str where: condition on the study areas, aliased b
+    """
+    if subdivided(db, table):
+        return f"""(
+            select b.id, sum(st_area(st_intersection(a.geom, b.geom))) / min(a.parent_area) as ratio,
+            {", ".join(f"min(a.{column}) as {column}" for column in columns)}
+            from {table}_subdivided a
+            inner join {polygon} b on st_intersects(a.geom, b.geom)
+            where {where}
+            group by b.id, a.ogc_fid
+        )"""
+    return f"""(
+            select b.id, st_area(st_intersection(a.geom, b.geom)) / st_area(a.geom) as ratio,
+            {", ".join(f"a.{column}" for column in columns)}
+            from {table} a
+            inner join {polygon} b on st_intersects(a.geom, b.geom)
+            where {where}
+        )"""
+
+
+def intersecting(db, table: str, geometry: str):
+    """
+    Returns a lateral subquery of the rows of table that intersect geometry, an
+    expression on the tables before it in the from clause. Use it as
+    `cross join {intersecting(...)} a`.
+    """
+    if subdivided(db, table):
+        return f"""lateral (
+            select distinct on (p.ogc_fid) p.*
+            from {table}_subdivided s
+            inner join {table} p on p.ogc_fid = s.ogc_fid
+            where st_intersects(s.geom, {geometry})
+        )"""
+    return f"""lateral (
+            select * from {table} p
+            where st_intersects(p.geom, {geometry})
+        )"""
@@ -0,0 +1,88 @@
+"""
+parallel.py
+------------------
+Fans the features of a FeatureCollection out to a process pool.
+
+Each segment's analysis only touches its own user_* rows, so features can run
+at the same time. Every worker process opens its own pooled DB connection.
+Results come back in input order, and an error on one feature is captured
+instead of aborting the rest of the run.
+
+"""
+
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from .connections import StudySegment
+from .pool import dispose_engines
+
+FeatureResult = namedtuple("FeatureResult", ["index", "name", "error"])
+
+
+def _run_feature(job):
+    """Runs one StudySegment in a worker, returning any error as a string"""
+    index, feature, kwargs = job
+    properties = feature.get("properties") or {}
+    name = properties.get("name") or properties.get("Name")
+    try:
+        StudySegment(feature=feature, **kwargs)
+        return FeatureResult(index, name, None)
+    except Exception as e:
+        return FeatureResult(index, name, f"{type(e).__name__}: {e}")
+
+
+def run_parallel(
+    network_type: str,
+    features,
+    username: str,
+    highest_comfort_level: int = 2,
+    overwrite: bool = False,
+    pg_config_filepath: str = None,
+    workers: int = None,
+    routing_engine: str = "pgrouting",
+):
+    """
+    Runs a StudySegment for every feature on a pool of worker processes.
+
+    :param int workers: number of processes, defaults to the number of cores.
+        Size this to the cores of your database host, that's where the work is.
+    :returns: a FeatureResult per feature, in input order
+    """
+    kwargs = {
+        "network_type": network_type,
+        "username": username,
+        "highest_comfort_level": highest_comfort_level,
+        "overwrite": overwrite,
+        "pg_config_filepath": pg_config_filepath,
+        "routing_engine": routing_engine,
+    }
+    # forked workers must not reuse the parent's pooled connections
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=dispose_engines)
+    # only a few features per worker are read ahead, so a streamed input stays
+    # streamed, and results are taken in input order
+    max_in_flight = 2 * (workers or os.cpu_count() or 1)
+    pending = deque()
+    results = []
+    progress = tqdm(unit="segment")
+
+    def collect(future):
+        result = future.result()
+        if result.error:
+            tqdm.write(f"segment {result.index} ({result.name}) failed: {result.error}")
+        progress.update()
+        results.append(result)
+
+    with executor:
+        for index, feature in enumerate(features):
+            pending.append(executor.submit(_run_feature, (index, feature, kwargs)))
+            while len(pending) >= max_in_flight:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+    progress.close()
+
+    failed = [result for result in results if result.error]
+    print(f"{len(results) - len(failed)} of {len(results)} segments processed.")
+
+    return results
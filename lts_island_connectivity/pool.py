@@ -0,0 +1,161 @@
+"""
+pool.py
+------------------
+Process-wide pooled database connections.
+
+StudySegment, network_islands.py and bh_firewall_read_data.py share one
+SQLAlchemy engine per database uri, so statements check a connection out of a
+pool instead of paying for a new connection (TCP + auth) every time.
+
+Pool size defaults to POOL_SIZE and MAX_OVERFLOW from your .env file.
+
+Every method takes either a query string or a prepared() Statement, see
+statements.py.
+
+"""
+
+from contextlib import contextmanager
+import pandas as pd
+from pg_data_etl import Database
+from sqlalchemy import create_engine, text
+from .settings import POOL_SIZE, MAX_OVERFLOW
+from .statements import Statement
+
+_engines = {}
+
+
+def get_engine(uri: str, pool_size: int = None, max_overflow: int = None):
+    """
+    Returns the shared engine for a uri, creating it on first use.
+    pool_size and max_overflow only apply when the engine is created.
+    """
+    if uri not in _engines:
+        _engines[uri] = create_engine(
+            uri,
+            pool_size=pool_size or POOL_SIZE,
+            max_overflow=max_overflow if max_overflow is not None else MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+    return _engines[uri]
+
+
+def get_database(
+    host: str = "localhost",
+    pg_config_filepath: str = None,
+    pool_size: int = None,
+    max_overflow: int = None,
+):
+    """Returns a PooledDatabase for a connection in your pg-data-etl config file"""
+    uri = Database.from_config(host, pg_config_filepath).uri
+    return PooledDatabase(uri, pool_size, max_overflow)
+
+
+def pool_stats():
+    """Returns the connection counts of every shared pool, keyed by database"""
+    stats = {}
+    for engine in _engines.values():
+        pool = engine.pool
+        stats[engine.url.render_as_string(hide_password=True)] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+    return stats
+
+
+def dispose_engines():
+    """
+    Drops every pooled connection. Call this in a forked child process so it
+    doesn't reuse the parent's sockets.
+    """
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+
+
+class PooledDatabase:
+    """
+    Pooled stand-in for pg_data_etl's Database, with the same execute, query,
+    query_as_singleton and df methods.
+    """
+
+    def __init__(self, uri: str, pool_size: int = None, max_overflow: int = None):
+        self.uri = uri
+        self.engine = get_engine(uri, pool_size, max_overflow)
+
+    def execute(self, query, params=None):
+        """
+        Runs a statement, returning the rowcount of its last command.
+        A list of params executes it once per dict, in one transaction.
+        """
+        with self.engine.begin() as connection:
+            return _run(connection, query, params).rowcount
+
+    def query(self, query, params: dict = None):
+        with self.engine.begin() as connection:
+            return [tuple(row) for row in _run(connection, query, params)]
+
+    def query_as_singleton(self, query, params: dict = None):
+        return self.query(query, params)[0][0]
+
+    def df(self, query, params: dict = None):
+        with self.engine.begin() as connection:
+            result = _run(connection, query, params)
+            return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields a TransactionDatabase: one pooled connection with a transaction
+        open on it, committed when the block exits and rolled back if it raises.
+        """
+        with self.engine.begin() as connection:
+            yield TransactionDatabase(self.uri, connection)
+
+    @contextmanager
+    def savepoint(self):
+        """Nothing to do, every call already runs in a transaction of its own"""
+        yield self
+
+
+class TransactionDatabase:
+    """
+    PooledDatabase's methods on a single connection, inside the transaction
+    open on it, see PooledDatabase.transaction. Session temp tables created on
+    it are visible to every later statement.
+    """
+
+    def __init__(self, uri: str, connection):
+        self.uri = uri
+        self.connection = connection
+        self.engine = connection.engine
+
+    def execute(self, query, params=None):
+        return _run(self.connection, query, params).rowcount
+
+    def query(self, query, params: dict = None):
+        return [tuple(row) for row in _run(self.connection, query, params)]
+
+    def query_as_singleton(self, query, params: dict = None):
+        return self.query(query, params)[0][0]
+
+    def df(self, query, params: dict = None):
+        result = _run(self.connection, query, params)
+        return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Runs the block in a SAVEPOINT, so a statement that fails in it can be
+        caught without aborting the whole transaction
+        """
+        with self.connection.begin_nested():
+            yield self
+
+
+def _run(connection, query, params=None):
+    """Executes a query string or a prepared Statement on a connection"""
+    if isinstance(query, Statement):
+        return query.execute(connection, params)
+    return connection.execute(text(query), params or {})
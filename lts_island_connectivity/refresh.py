@@ -0,0 +1,139 @@
+"""
+refresh.py
+------------------
+Change detection for the imported layers and everything built from them.
+
+Each table gets a signature, kept in public.layer_refresh_state. Imported layers
+are signed by their source query's row count and a checksum of its rows, taken
+on the source database. Tables built from other tables (low stress networks,
+islands, topology) are signed by the signatures of their inputs. A table only
+has to be rebuilt when its signature changed since it was last built.
+
+The same signatures key the in-process caches of data loaded from these tables
+(routing graphs, island graphs, subdivided layers, results), see cache_version,
+so a long-lived process picks up a rebuild without restarting. The signatures
+are read at most once every REFRESH_CHECK_INTERVAL seconds, so a rebuild by
+another process takes up to that long to be noticed.
+
+"""
+
+import hashlib
+import time
+from .settings import DATA_VERSION, REFRESH_CHECK_INTERVAL
+from .statements import prepared
+
+# uri: (time read, {tablename: signature}) of each database's refresh state
+_signatures = {}
+
+
+def setup_refresh_state(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS public.layer_refresh_state(
+            tablename VARCHAR PRIMARY KEY,
+            signature VARCHAR,
+            refreshed_at TIMESTAMPTZ
+        )
+        """
+    )
+
+
+def source_signature(db, sql_query: str, checksum: bool = True):
+    """
+    Signs the rows of a source query. Without checksum only the row count is used,
+    which is cheaper but misses edits that don't add or remove rows.
+    """
+    if checksum:
+        digest = "md5(string_agg(md5(t::text), '' order by md5(t::text)))"
+    else:
+        digest = "''"
+    count, rows_digest = db.query(f"select count(*), {digest} from ({sql_query}) t")[0]
+    return f"{count}:{rows_digest or ''}"
+
+
+def stored_signature(db, tablename: str):
+    result = db.query(
+        prepared(
+            "select signature from public.layer_refresh_state where tablename = :tablename"
+        ),
+        {"tablename": tablename},
+    )
+    return result[0][0] if result else None
+
+
+def store_signature(db, tablename: str, signature: str):
+    db.execute(
+        prepared(
+            """
+            insert into public.layer_refresh_state (tablename, signature, refreshed_at)
+            values (:tablename, :signature, now())
+            on conflict (tablename) do update
+            set signature = excluded.signature, refreshed_at = excluded.refreshed_at
+            """
+        ),
+        {"tablename": tablename, "signature": signature},
+    )
+    # this process sees its own rebuilds right away
+    _signatures.pop(db.uri, None)
+
+
+def derived_signature(db, inputs: list, parameters: dict = None):
+    """
+    Signs a table built from other tables, and from any parameters of the build.
+    Returns None when an input has never been signed, so the table is always
+    rebuilt.
+    """
+    signatures = [stored_signature(db, tablename) for tablename in inputs]
+    if None in signatures:
+        return None
+    joined = "|".join(f"{name}={sig}" for name, sig in zip(inputs, signatures))
+    if parameters:
+        joined += "|" + "|".join(f"{key}={value}" for key, value in parameters.items())
+    return hashlib.md5(joined.encode()).hexdigest()
+
+
+def needs_refresh(db, tablename: str, signature: str, full_refresh: bool = False):
+    """Whether a table is missing, unsigned, or signed differently than signature"""
+    if full_refresh or signature is None:
+        return True
+    exists = db.query_as_singleton(
+        prepared("select to_regclass(:tablename) is not null"),
+        {"tablename": tablename},
+    )
+    return not exists or stored_signature(db, tablename) != signature
+
+
+def refresh_signatures(db):
+    """
+    Returns every stored signature, read from the database at most once every
+    REFRESH_CHECK_INTERVAL seconds. Empty when there's no refresh state.
+    """
+    read_at, stored = _signatures.get(db.uri, (None, None))
+    if read_at is not None and time.monotonic() - read_at < REFRESH_CHECK_INTERVAL:
+        return stored
+    stored = {}
+    if db.query_as_singleton(
+        "select to_regclass('public.layer_refresh_state') is not null"
+    ):
+        stored = dict(
+            db.query("select tablename, signature from public.layer_refresh_state")
+        )
+    _signatures[db.uri] = (time.monotonic(), stored)
+    return stored
+
+
+def cache_version(db, tablenames: list):
+    """
+    Returns DATA_VERSION and the stored signatures of tables, for caches of data
+    loaded from them. It changes once any of the tables is rebuilt, tables that
+    were never signed are left out.
+    """
+    stored = refresh_signatures(db)
+    return (
+        DATA_VERSION,
+        *(
+            (tablename, stored[tablename])
+            for tablename in sorted(tablenames)
+            if tablename in stored
+        ),
+    )
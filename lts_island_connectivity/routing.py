@@ -0,0 +1,197 @@
+"""
+routing.py
+------------------
+In-memory routing engine for isochrones.
+
+pgr_drivingDistance rebuilds the graph from the whole low stress table on every
+call. This module loads source/target/traveltime_min once per process into a
+compact array-backed (CSR) graph and runs a multi-source Dijkstra with a cutoff,
+returning the same reachable node set. A graph is loaded again once
+network_islands.py rebuilds its table, see refresh.cache_version.
+
+"""
+
+import heapq
+import numpy as np
+from .refresh import cache_version
+from .statements import prepared
+
+# speeds used to build traveltime_min in network_islands.py
+NETWORK_SPEEDS_KMH = {"lts": 16.0, "sidewalk": 4.82}
+
+# signed by network_islands.py when it rebuilds a network's topology
+TOPOLOGY_TABLES = {
+    "lts": "lts.lts_full_vertices_pgr",
+    "sidewalk": "sidewalk.sidewalknodes",
+}
+
+_graphs = {}
+_edge_speeds = {}
+
+
+class CSRGraph:
+    """
+    Undirected graph in compressed sparse row form. Neighbours of node i are
+    indices[indptr[i]:indptr[i + 1]], with edge costs in the same slice of weights.
+    Node ids are the source/target ids of the network table.
+    """
+
+    def __init__(self, node_ids, indptr, indices, weights):
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        # plain lists are much faster than numpy scalars inside the dijkstra loop
+        self._indptr = indptr.tolist()
+        self._indices = indices.tolist()
+        self._weights = weights.tolist()
+
+    @classmethod
+    def from_edges(cls, sources, targets, costs, directed: bool = False):
+        """
+        Builds the graph from edge arrays. Like pgRouting, edges with a negative
+        or missing cost are left out.
+        """
+        sources = np.asarray(sources, dtype=np.float64)
+        targets = np.asarray(targets, dtype=np.float64)
+        costs = np.asarray(costs, dtype=np.float64)
+
+        keep = ~(np.isnan(sources) | np.isnan(targets) | np.isnan(costs))
+        keep &= costs >= 0
+        sources = sources[keep].astype(np.int64)
+        targets = targets[keep].astype(np.int64)
+        costs = costs[keep]
+
+        node_ids = np.unique(np.concatenate([sources, targets]))
+        s = np.searchsorted(node_ids, sources)
+        t = np.searchsorted(node_ids, targets)
+        if not directed:
+            s, t = np.concatenate([s, t]), np.concatenate([t, s])
+            costs = np.concatenate([costs, costs])
+
+        order = np.argsort(s, kind="stable")
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(s, minlength=len(node_ids)), out=indptr[1:])
+
+        return cls(node_ids, indptr, t[order], costs[order])
+
+    def reachable(self, start_nodes, cutoff: float):
+        """
+        Multi-source Dijkstra. Returns {node id: cost} for every node whose cost
+        from the nearest start node is within cutoff, start nodes included.
+        """
+        starts = np.unique(np.asarray(list(start_nodes), dtype=np.int64))
+        positions = np.searchsorted(self.node_ids, starts)
+        found = positions < len(self.node_ids)
+        found[found] = self.node_ids[positions[found]] == starts[found]
+        positions = positions[found]
+
+        best = {}
+        heap = [(0.0, position) for position in positions.tolist()]
+        heapq.heapify(heap)
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node in best:
+                continue
+            best[node] = cost
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                if neighbour in best:
+                    continue
+                new_cost = cost + weights[edge]
+                if new_cost <= cutoff:
+                    heapq.heappush(heap, (new_cost, neighbour))
+
+        node_ids = self.node_ids
+        return {int(node_ids[node]): cost for node, cost in best.items()}
+
+
+def network_version(db, network_type: str, ls_table: str):
+    """The cache_version of a low stress table and its network's topology"""
+    return cache_version(
+        db, [f"{network_type}.{ls_table}", TOPOLOGY_TABLES[network_type]]
+    )
+
+
+def load_graph(db, network_type: str, ls_table: str):
+    """
+    Returns the CSRGraph of a low stress table, loading it from the database the
+    first time it is asked for in this process, and again after it's rebuilt.
+    """
+    key = (db.uri, network_type, ls_table)
+    version = network_version(db, network_type, ls_table)
+    if key not in _graphs or _graphs[key][0] != version:
+        print(f"loading {network_type}.{ls_table} into memory, please wait..")
+        df = db.df(
+            f"""select source, target, traveltime_min as cost
+                from {network_type}.{ls_table}"""
+        )
+        graph = CSRGraph.from_edges(df["source"], df["target"], df["cost"])
+        _graphs[key] = (version, graph)
+    return _graphs[key][1]
+
+
+def reachable_nodes(
+    db,
+    network_type: str,
+    ls_table: str,
+    nodes_table: str,
+    study_segment_id: int,
+    travel_time: int = 15,
+    buffers_table: str = None,
+):
+    """
+    Returns the ids of the nodes reachable within travel_time minutes of a study
+    segment. Start nodes are the sources of the low stress segments that touch the
+    segment's buffer, the same ones handed to pgr_drivingDistance.
+
+    :param str buffers_table: where the segment's buffer is, {network_type}.user_buffers
+        by default
+    """
+    graph = load_graph(db, network_type, ls_table)
+    start_nodes = db.query(
+        prepared(
+            f"""
+            select distinct b."source" from {network_type}.{nodes_table} a
+            inner join {network_type}.{ls_table} b on a.id = b."source"
+            inner join {buffers_table or f"{network_type}.user_buffers"} c on st_intersects(c.geom, b.geom)
+            where c.id = :id
+            """
+        ),
+        {"id": study_segment_id},
+    )
+    return list(graph.reachable([row[0] for row in start_nodes], travel_time))
+
+
+def isochrone_radius(db, network_type: str, ls_table: str, travel_time: int = 15):
+    """
+    Returns the furthest straight-line distance, in the units of the network's
+    geometry, that can be covered within travel_time minutes.
+
+    The nominal speed of the network is checked against the fastest edge of the
+    table (geometric length over traveltime_min), so rounding in length_m can't make
+    the radius too small, and edges that round down to zero cost are added at their
+    full length. Any edge on a path within travel_time lies inside this radius of a
+    start node, so restricting pgr_drivingDistance to it doesn't change the result.
+    """
+    key = (db.uri, network_type, ls_table)
+    version = network_version(db, network_type, ls_table)
+    if key not in _edge_speeds or _edge_speeds[key][0] != version:
+        _edge_speeds[key] = (
+            version,
+            db.query(
+                f"""
+            select
+                coalesce(max(st_length(geom) / traveltime_min) filter (where traveltime_min > 0), 0),
+                coalesce(sum(st_length(geom)) filter (where traveltime_min = 0), 0)
+            from {network_type}.{ls_table}
+            """
+            )[0],
+        )
+    fastest_edge, zero_cost_length = _edge_speeds[key][1]
+    speed = max(NETWORK_SPEEDS_KMH[network_type] * 1000 / 60, fastest_edge)
+
+    # one extra meter covers the topology snapping tolerance
+    return speed * travel_time + zero_cost_length + 1
@@ -0,0 +1,85 @@
+"""
+scenarios.py
+------------------
+Ranks alternative alignments for the same gap without running StudySegment.
+
+ScenarioAnalyzer scores candidate features against the island graph of one
+network, loaded once per process and shared by every analyzer, and returns
+their benefit metrics ranked. Nothing is written to the database, so planners
+can compare dozens of alternatives interactively and only run the full
+StudySegment on the ones worth keeping.
+
+"""
+
+from .island_graph import get_island_graph, to_network_crs
+from .pool import get_database
+
+# metrics a ranking can be ordered by
+RANKABLE = ["miles", "islands_joined", "total_pop", "total_jobs", "essential_services"]
+
+
+class ScenarioAnalyzer:
+    """
+    Read-only scoring of candidate segments on one network and comfort level.
+
+    :param int distance: buffer around each candidate in meters, 30 like
+        StudySegment's study segment buffer
+    """
+
+    def __init__(
+        self,
+        network_type: str = "lts",
+        highest_comfort_level: int = 2,
+        pg_config_filepath: str = None,
+        distance: float = 30,
+    ) -> None:
+        self.network_type = network_type
+        self.highest_comfort_level = highest_comfort_level
+        self.distance = distance
+        self.db = get_database("localhost", pg_config_filepath)
+        self.graph = get_island_graph(self.db, network_type, highest_comfort_level)
+
+    def score(self, features: list):
+        """
+        Scores each feature on its own, returning a dict per feature with its
+        index, name, the islands it touches and their combined metrics.
+        """
+        geometries = [to_network_crs(feature["geometry"]) for feature in features]
+        scores = []
+        for index, (feature, summary) in enumerate(
+            zip(features, self.graph.score(geometries, self.distance))
+        ):
+            properties = feature.get("properties") or {}
+            summary["index"] = index
+            summary["name"] = properties.get("name") or properties.get("Name")
+            summary["islands_joined"] = len(summary["islands"])
+            scores.append(summary)
+        return scores
+
+    def rank(self, features: list, by: str = "miles"):
+        """
+        Returns the scores of every feature, best first, each with its rank.
+        Ties keep the order the features were given in.
+
+        :param str by: one of RANKABLE. essential_services ranks by the total
+            count of services of every type
+        """
+        if by not in RANKABLE:
+            raise ValueError(f"can't rank by {by}, should be one of {RANKABLE}")
+
+        def metric(score):
+            value = score[by]
+            return sum(value.values()) if isinstance(value, dict) else value
+
+        ranked = sorted(self.score(features), key=metric, reverse=True)
+        for rank, score in enumerate(ranked, start=1):
+            score["rank"] = rank
+        return ranked
+
+    def combine(self, features: list):
+        """
+        Scores features built together, see IslandGraph.combine. Returns a summary
+        per merged group of islands, with the indices of the features that join it.
+        """
+        geometries = [to_network_crs(feature["geometry"]) for feature in features]
+        return self.graph.combine(geometries, self.distance)
@@ -0,0 +1,195 @@
+"""
+schema.py
+------------------
+Versioned bootstrap of the user_* tables of each network schema.
+
+MIGRATIONS are applied in order, once per network schema, and the version a
+schema is at is kept in public.user_schema_version. ensure_schema checks the
+version once per process and only migrates a schema that's behind, so scoring a
+segment never runs DDL. Every migration is idempotent, so databases created
+before this module existed are brought up to date in place.
+
+    python -m lts_island_connectivity.schema
+
+migrates the lts and sidewalk schemas, `make schema` does the same. Add a new
+migration at the end of MIGRATIONS to change the tables, never edit one that
+has shipped.
+
+"""
+
+from .statements import prepared
+
+NETWORK_TYPES = ["lts", "sidewalk"]
+
+# the tables holding each segment's polygons, keyed by segment id
+POLYGON_TABLES = ["user_buffers", "user_islands", "user_blobs", "user_isochrones"]
+
+_current = set()
+
+
+def _create_tables(network_type: str):
+    polygon_tables = "\n".join(
+        f"""
+        CREATE TABLE IF NOT EXISTS {network_type}.{table}(
+            id SERIAL PRIMARY KEY,
+            username VARCHAR,
+            geom GEOMETRY
+        );"""
+        for table in POLYGON_TABLES
+    )
+    return f"""
+        CREATE TABLE IF NOT EXISTS {network_type}.user_segments(
+            id SERIAL PRIMARY KEY,
+            username VARCHAR,
+            seg_name VARCHAR,
+            network_type VARCHAR,
+            highest_comfort_level INT,
+            ls_table VARCHAR,
+            ids VARCHAR,
+            nodes_table VARCHAR,
+            has_isochrone BOOL,
+            miles REAL,
+            total_pop INT,
+            disabled INT,
+            ethnic_minority INT,
+            female INT,
+            foreign_born INT,
+            lep INT,
+            low_income INT,
+            older_adult INT,
+            racial_minority INT,
+            youth INT,
+            circuit JSON,
+            total_jobs INT,
+            bike_ped_crashes JSON,
+            essential_services JSON,
+            rail_stations JSON,
+            stage_metrics JSON,
+            deleted BOOL,
+            shared BOOL,
+            geom GEOMETRY
+        );
+        {polygon_tables}
+        """
+
+
+def _add_columns(network_type: str):
+    # columns older databases got from ALTER TABLEs at request time
+    return f"""
+        ALTER TABLE {network_type}.user_islands ADD COLUMN IF NOT EXISTS size_miles FLOAT;
+        ALTER TABLE {network_type}.user_isochrones ADD COLUMN IF NOT EXISTS miles FLOAT;
+        ALTER TABLE {network_type}.user_segments ADD COLUMN IF NOT EXISTS stage_metrics JSON;
+        """
+
+
+def _create_indexes(network_type: str):
+    gist = "\n".join(
+        f"""
+        CREATE INDEX IF NOT EXISTS {table}_geom_idx
+        ON {network_type}.{table} USING gist (geom);"""
+        for table in ["user_segments", *POLYGON_TABLES]
+    )
+    return f"""
+        CREATE INDEX IF NOT EXISTS user_segments_username_seg_name_idx
+        ON {network_type}.user_segments (username, seg_name);
+        {gist}
+        """
+
+
+def _create_staging_table(network_type: str):
+    # features of a BatchStudySegments run, see batch.py
+    return f"""
+        CREATE TABLE IF NOT EXISTS {network_type}.user_segments_staging(
+            batch_id VARCHAR,
+            feature_index INT,
+            username VARCHAR,
+            seg_name VARCHAR,
+            segment_id INT,
+            has_isochrone BOOL,
+            geom GEOMETRY
+        );
+        CREATE INDEX IF NOT EXISTS user_segments_staging_batch_id_idx
+        ON {network_type}.user_segments_staging (batch_id);
+        """
+
+
+# functions returning the DDL of each version, for a network schema
+MIGRATIONS = [_create_tables, _add_columns, _create_indexes, _create_staging_table]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def setup_schema_version(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS public.user_schema_version(
+            network_type VARCHAR PRIMARY KEY,
+            version INT,
+            migrated_at TIMESTAMPTZ
+        )
+        """
+    )
+
+
+def schema_version(db, network_type: str):
+    """
+    Returns the version a network schema is at, 0 when it has never been
+    migrated or its user_segments table has since been dropped.
+    """
+    if not db.query_as_singleton(
+        "select to_regclass('public.user_schema_version') is not null"
+    ):
+        return 0
+    version = db.query(
+        prepared(
+            """
+            select version from public.user_schema_version
+            where network_type = :network_type
+            and to_regclass(:network_type || '.user_segments') is not null
+            """
+        ),
+        {"network_type": network_type},
+    )
+    return version[0][0] if version else 0
+
+
+def migrate(db, network_type: str):
+    """
+    Applies the migrations a network schema is missing, each in its own
+    transaction. Concurrent migrations wait on an advisory lock.
+    """
+    setup_schema_version(db)
+    for version in range(schema_version(db, network_type), SCHEMA_VERSION):
+        print(f"migrating {network_type} user tables to version {version + 1}..")
+        db.execute(
+            f"""
+            select pg_advisory_xact_lock(hashtext('user_schema_version'));
+            {MIGRATIONS[version](network_type)}
+            insert into public.user_schema_version
+            values ('{network_type}', {version + 1}, now())
+            on conflict (network_type) do update
+            set version = greatest(user_schema_version.version, excluded.version),
+            migrated_at = excluded.migrated_at;
+            """
+        )
+    _current.add((db.uri, network_type))
+
+
+def ensure_schema(db, network_type: str):
+    """
+    Migrates a network schema if it's behind, checked once per process. This is
+    the only schema work done when scoring segments.
+    """
+    if (db.uri, network_type) in _current:
+        return
+    if schema_version(db, network_type) < SCHEMA_VERSION:
+        migrate(db, network_type)
+    _current.add((db.uri, network_type))
+
+
+if __name__ == "__main__":
+    from .pool import get_database
+
+    db = get_database("localhost")
+    for network_type in NETWORK_TYPES:
+        migrate(db, network_type)
@@ -16,3 +16,47 @@ GIS_USER = os.getenv("GIS_USER")
 GIS_DB_NAME = os.getenv("GIS_DB_NAME")
 GIS_PASSWORD = os.getenv("GIS_PASSWORD")
 GIS_PORT = os.getenv("GIS_PORT")
+
+POOL_SIZE = int(os.getenv("POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.getenv("MAX_OVERFLOW", 10))
+
+# bump when the network or overlay data is reimported, so cached results expire
+DATA_VERSION = os.getenv("DATA_VERSION", "1")
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_MAX_AGE = (
+    int(os.getenv("RESULT_CACHE_MAX_AGE")) if os.getenv("RESULT_CACHE_MAX_AGE") else None
+)
+# seconds between checks of public.layer_refresh_state for rebuilt tables, see refresh.py
+REFRESH_CHECK_INTERVAL = float(os.getenv("REFRESH_CHECK_INTERVAL", 60))
+
+# turn off when connecting through a pooler in transaction mode
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "true").lower() not in (
+    "false",
+    "0",
+    "no",
+)
+
+# number of layers bh_firewall_read_data.py imports at the same time
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 4))
+
+# meters to simplify the precomputed 100m island buffers by, 0 keeps them exact
+ISLAND_BUFFER_SIMPLIFY = float(os.getenv("ISLAND_BUFFER_SIMPLIFY", 0))
+
+# most vertices per piece of the subdivided overlay layers, see overlays.py
+SUBDIVIDE_MAX_VERTICES = int(os.getenv("SUBDIVIDE_MAX_VERTICES", 256))
+
+# DVRPC's crash API, see crashes.py. crashes are only pulled with PULL_CRASHES
+PULL_CRASHES = os.getenv("PULL_CRASHES", "false").lower() in ("true", "1", "yes")
+CRASH_API_URL = os.getenv(
+    "CRASH_API_URL", "https://cloud.dvrpc.org/api/crash-data/v1/summary"
+)
+CRASH_API_TIMEOUT = float(os.getenv("CRASH_API_TIMEOUT", 10))
+CRASH_API_RETRIES = int(os.getenv("CRASH_API_RETRIES", 3))
+CRASH_API_WORKERS = int(os.getenv("CRASH_API_WORKERS", 8))
+# empty to not cache crash summaries on disk
+CRASH_CACHE_DIR = os.getenv(
+    "CRASH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lts_crashes")
+)
+CRASH_CACHE_MAX_AGE = (
+    int(os.getenv("CRASH_CACHE_MAX_AGE")) if os.getenv("CRASH_CACHE_MAX_AGE") else None
+)
@@ -0,0 +1,91 @@
+"""
+statements.py
+------------------
+Server-side prepared statements for the segment pipeline.
+
+Wrap a query written with :name bind parameters in prepared() and hand it to
+PooledDatabase's execute, query or df. The first time a pooled connection runs
+it, the query is sent once as PREPARE, and every later run on that connection
+is an EXECUTE with just the values, so postgres parses and plans it once per
+connection instead of once per segment.
+
+Only identifiers (schemas, tables, columns) may be formatted into the query,
+values must be bind parameters, otherwise every segment gets its own statement.
+
+Set PREPARED_STATEMENTS=false in your .env file when connecting through a pooler
+in transaction mode (pgbouncer), queries then run as ordinary bound statements.
+
+"""
+
+import hashlib
+import re
+from sqlalchemy import text
+from .settings import PREPARED_STATEMENTS
+
+# same rule sqlalchemy's text() uses, so ::casts aren't taken for parameters
+BIND_PARAM = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+
+_statements = {}
+
+
+class Statement:
+    """A query with :name parameters, prepared on each connection that runs it"""
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.name = "lts_" + hashlib.sha1(sql.encode()).hexdigest()[:16]
+        self.params = []
+        for param in BIND_PARAM.findall(sql):
+            if param not in self.params:
+                self.params.append(param)
+        positional = BIND_PARAM.sub(
+            lambda match: f"${self.params.index(match.group(1)) + 1}", sql
+        )
+        self.prepare_sql = f"PREPARE {self.name} AS {positional}"
+        if self.params:
+            arguments = ", ".join(f":{param}" for param in self.params)
+            self.execute_sql = f"EXECUTE {self.name}({arguments})"
+        else:
+            self.execute_sql = f"EXECUTE {self.name}"
+
+    def __str__(self):
+        return self.sql
+
+    def execute(self, connection, params=None):
+        """Runs the statement on a connection, preparing it there first if needed"""
+        if not PREPARED_STATEMENTS:
+            return connection.execute(text(self.sql), params or {})
+        try:
+            names = _prepared_names(connection)
+            if self.name not in names:
+                connection.execute(text(self.prepare_sql))
+                names.add(self.name)
+            return connection.execute(text(self.execute_sql), params or {})
+        except Exception:
+            # the connection's statements are read again after a failure
+            connection.info.pop("prepared_statements", None)
+            raise
+
+
+def _prepared_names(connection):
+    """
+    Names of the statements prepared on a pooled connection. They're kept in the
+    connection's info, which is reset when the pool replaces the connection.
+    """
+    names = connection.info.get("prepared_statements")
+    if names is None:
+        names = {
+            row[0]
+            for row in connection.execute(
+                text("select name from pg_prepared_statements")
+            )
+        }
+        connection.info["prepared_statements"] = names
+    return names
+
+
+def prepared(sql: str):
+    """Returns the Statement for a query, defining it once per process"""
+    if sql not in _statements:
+        _statements[sql] = Statement(sql)
+    return _statements[sql]
@@ -0,0 +1,127 @@
+"""
+streaming.py
+------------------
+Streams features out of GeoJSON files without loading the whole file.
+
+Handles a single Feature, a FeatureCollection, and newline-delimited GeoJSON
+(one Feature, or FeatureCollection, per line). The file is read in chunks and
+each feature is decoded and yielded as soon as it's complete, so memory stays
+flat regardless of file size and processing starts before the file is parsed.
+
+"""
+
+import json
+
+_decoder = json.JSONDecoder()
+
+
+class _ChunkReader:
+    """Minimal incremental JSON tokenizer over a text file"""
+
+    def __init__(self, f, chunk_size: int):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self, chunk_size: int = None):
+        chunk = self.f.read(chunk_size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+        # drop what's already consumed, so the buffer never holds the whole file
+        self.buffer = self.buffer[self.position :] + chunk
+        self.position = 0
+
+    def peek(self):
+        """Returns the next non-whitespace character, '' at the end of the file"""
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position].isspace()
+            ):
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position : self.position + 1]
+            self.fill()
+
+    def next(self):
+        character = self.peek()
+        self.position += 1
+        return character
+
+    def expect(self, character: str):
+        found = self.next()
+        if found != character:
+            raise ValueError(f"expected '{character}' in geojson, found '{found}'")
+
+    def value(self):
+        """Decodes the next complete JSON value"""
+        self.peek()
+        chunk_size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+                # a value running to the end of the buffer might be cut short
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # big values get bigger reads, so they aren't re-decoded for every chunk
+            self.fill(chunk_size)
+            chunk_size *= 2
+
+
+def _stream_object(reader: _ChunkReader):
+    """
+    Yields the features of one top level object: each member of a
+    FeatureCollection's features array, or the object itself if it's a Feature.
+    """
+    reader.expect("{")
+    members = {}
+    if reader.peek() == "}":
+        reader.next()
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "features" and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.next()
+            else:
+                while True:
+                    yield reader.value()
+                    separator = reader.next()
+                    if separator == "]":
+                        break
+                    if separator != ",":
+                        raise ValueError("malformed features array in geojson")
+        else:
+            members[key] = reader.value()
+
+        separator = reader.next()
+        if separator == "}":
+            break
+        if separator != ",":
+            raise ValueError("malformed object in geojson")
+
+    if members.get("type") == "Feature":
+        yield members
+
+
+def iter_features(path: str, chunk_size: int = 1 << 16):
+    """
+    Yields each feature of a GeoJSON or newline-delimited GeoJSON file as a dict.
+    Top level objects that aren't a Feature or FeatureCollection are skipped.
+    """
+    with open(path, encoding="utf-8") as f:
+        reader = _ChunkReader(f, chunk_size)
+        while reader.peek():
+            if reader.peek() == "{":
+                yield from _stream_object(reader)
+            else:
+                # skip any other top level value
+                reader.value()
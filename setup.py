@@ -8,7 +8,7 @@ setup(
     install_requires=[
         "geoalchemy2",
         "geopandas",
-        "network-routing @ git+https://github.com/dvrpc/network-routing",
+        "numpy",
         "pandana",
         "pg-data-etl @ git+https://github.com/mmorley0395/pg-data-etl",
         "pip-chill",
@@ -16,6 +16,9 @@ setup(
         "python-dotenv",
         "tqdm",
         "requests",
+        "shapely>=2",
+        "pyproj",
     ],
+    extras_require={"async": ["asyncpg", "sqlalchemy[asyncio]"]},
     entry_points={"console_scripts": ["connect = lts_island_connectivity.cli:cx"]},
 )